@@ -4,6 +4,7 @@ from celery import Celery
 from celery.app.log import TaskFormatter as CeleryTaskFormatter
 from celery.signals import after_setup_task_logger, after_setup_logger
 from celery._state import get_current_task
+from django.conf import settings
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'app.settings')
@@ -12,12 +13,38 @@ app = Celery('bot')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
+# Replies to a user's click go to 'interactive' so they never wait behind
+# long sends on 'bulk'; broadcasts to every user get 'broadcast' so they do
+# not hold up shares, approvals and the periodic stats tasks either. Each
+# queue has its own workers in docker-compose.yml
+BULK_QUEUE = 'bulk'
+BROADCAST_QUEUE = 'broadcast'
+
 app.conf.update(
-    task_default_queue='sender',
+    task_default_queue='interactive',
+    task_routes={
+        'bot.tasks.send_message_share': {'queue': BULK_QUEUE},
+        'bot.tasks.send_message_approve': {'queue': BULK_QUEUE},
+        'bot.tasks.broadcast_share': {'queue': BROADCAST_QUEUE},
+        'bot.tasks.send_broadcast_batch': {'queue': BROADCAST_QUEUE},
+        'bot.tasks.flush_user_activity': {'queue': BULK_QUEUE},
+        'bot.tasks.get_users_count': {'queue': BULK_QUEUE},
+        'bot.tasks.rollup_stats': {'queue': BULK_QUEUE},
+    },
+    # A worker takes one task at a time, a long send must not hold queued replies
+    worker_prefetch_multiplier=1,
     beat_schedule={
+        'flush_user_activity': {
+            'task': 'bot.tasks.flush_user_activity',
+            'schedule': settings.ACTIVITY_FLUSH_INTERVAL
+        },
         'get_users_count': {
             'task': 'bot.tasks.get_users_count',
-            'schedule': 15
+            'schedule': settings.STATS_USERS_COUNT_INTERVAL
+        },
+        'rollup_stats': {
+            'task': 'bot.tasks.rollup_stats',
+            'schedule': settings.STATS_ROLLUP_INTERVAL
         }
     }
 )
@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'bot',
     # 'django_extensions',
 ]
@@ -84,7 +85,20 @@ DATABASES = {
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD'),
         'HOST': os.environ.get('POSTGRES_HOST', 'postgres'),
         'PORT': os.environ.get('POSTGRES_PORT', '5432'),
-        'CONN_MAX_AGE': 0,
+        # Set per process type: the ASGI web workers go through pgbouncer and
+        # close their connection after every request, the Celery workers keep
+        # a direct connection open and check it before reuse
+        'CONN_MAX_AGE': int(os.environ.get('DJANGO_CONN_MAX_AGE', 0)),
+        'CONN_HEALTH_CHECKS': bool(int(os.environ.get('DJANGO_CONN_HEALTH_CHECKS', 1))),
+        # Required behind pgbouncer in transaction pooling mode
+        'DISABLE_SERVER_SIDE_CURSORS': bool(int(os.environ.get('DJANGO_DISABLE_SERVER_SIDE_CURSORS', 0))),
+        'OPTIONS': {
+            'connect_timeout': int(os.environ.get('POSTGRES_CONNECT_TIMEOUT', 5)),
+            'keepalives': 1,
+            'keepalives_idle': 60,
+            'keepalives_interval': 10,
+            'keepalives_count': 3,
+        },
     },
 }
 
@@ -150,16 +164,47 @@ CACHES = {
     }
 }
 
+CONVERSATION_REDIS_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/1'
+CONVERSATION_STATE_TTL = int(os.environ.get('CONVERSATION_STATE_TTL', 3600))
+CAPTION_TTL = int(os.environ.get('CAPTION_TTL', 24 * 3600))
+ACTIVITY_FLUSH_INTERVAL = int(os.environ.get('ACTIVITY_FLUSH_INTERVAL', 10))
+ACTIVITY_FLUSH_BATCH_SIZE = int(os.environ.get('ACTIVITY_FLUSH_BATCH_SIZE', 1000))
+STATS_TTL = int(os.environ.get('STATS_TTL', 3 * 24 * 3600))
+STATS_ROLLUP_INTERVAL = int(os.environ.get('STATS_ROLLUP_INTERVAL', 60))
+STATS_USERS_COUNT_INTERVAL = int(os.environ.get('STATS_USERS_COUNT_INTERVAL', 6 * 3600))
+
 CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Europe/Kiev'
 
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', 10))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', 5))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', 30))
+TELEGRAM_CONNECT_RETRIES = int(os.environ.get('TELEGRAM_CONNECT_RETRIES', 2))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_GLOBAL_BURST = int(os.environ.get('TELEGRAM_GLOBAL_BURST', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = int(os.environ.get('TELEGRAM_CHAT_BURST', 5))
+TELEGRAM_BULK_RATE = float(os.environ.get('TELEGRAM_BULK_RATE', 20))
+TELEGRAM_BULK_BURST = int(os.environ.get('TELEGRAM_BULK_BURST', 20))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 5))
+TELEGRAM_ALBUM_MODE = bool(int(os.environ.get('TELEGRAM_ALBUM_MODE', 1)))
 TELEGRAM_CHANNEL_ID = os.environ.get('TELEGRAM_CHANNEL_ID')
 X_TELEGRAM_BOT_API_SECRET_TOKEN = os.environ.get('X_TELEGRAM_BOT_API_SECRET_TOKEN')
+TELEGRAM_UPDATE_DEDUP_TTL = int(os.environ.get('TELEGRAM_UPDATE_DEDUP_TTL', 3600))
+BROADCAST_BATCH_SIZE = int(os.environ.get('BROADCAST_BATCH_SIZE', 100))
+BROADCAST_CHUNK_SIZE = int(os.environ.get('BROADCAST_CHUNK_SIZE', 2000))
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 500))
 APP_API_ID = os.environ.get('APP_API_ID')
 APP_API_HASH = os.environ.get('APP_API_HASH')
+RESULTS_PAGE_SIZE = int(os.environ.get('RESULTS_PAGE_SIZE', 5))
+SPECIALITY_SEARCH_THRESHOLD = float(os.environ.get('SPECIALITY_SEARCH_THRESHOLD', 0.5))
+SPECIALITY_SEARCH_LIMIT = int(os.environ.get('SPECIALITY_SEARCH_LIMIT', 20))
+DIRECTORY_SEARCH_CONFIG = os.environ.get('DIRECTORY_SEARCH_CONFIG', 'russian')
+DIRECTORY_SEARCH_LIMIT = int(os.environ.get('DIRECTORY_SEARCH_LIMIT', 10))
 CHANNEL_URL = 'https://t.me/vsezdesodessa'
 
 LOGGING = {
@@ -0,0 +1,70 @@
+import json
+import time
+import logging
+from datetime import datetime, timezone
+from django.conf import settings
+from bot.models import User
+from bot import state, stats
+
+
+# Users seen by the webhook are buffered in one Redis hash, user id -> latest
+# profile and activity time, and written to the users table by a periodic
+# flush, so handling an update never writes to Postgres.
+
+BUFFER_KEY = 'user_activity'
+UPDATE_FIELDS = ('username', 'first_name', 'last_name', 'last_seen', 'is_deleted', 'updated')
+
+
+async def arecord(from_user):
+    if not from_user.id:
+        return
+    value = json.dumps({
+        'username': from_user.username or None,
+        'first_name': from_user.first_name or None,
+        'last_name': from_user.last_name or None,
+        'last_seen': time.time(),
+    })
+    async with state.get_client().pipeline(transaction=False) as pipe:
+        pipe.hset(BUFFER_KEY, from_user.id, value)
+        stats.active_users_commands(pipe, from_user.id)
+        await pipe.execute()
+
+
+def flush():
+    client = state.get_sync_client()
+    with client.pipeline(transaction=True) as pipe:
+        pipe.hgetall(BUFFER_KEY)
+        pipe.delete(BUFFER_KEY)
+        buffer, _ = pipe.execute()
+    if not buffer:
+        return 0
+    users = []
+    for user_id, value in buffer.items():
+        value = json.loads(value)
+        users.append(User(
+            id=int(user_id),
+            username=value['username'],
+            first_name=value['first_name'],
+            last_name=value['last_name'],
+            last_seen=datetime.fromtimestamp(value['last_seen'], tz=timezone.utc),
+            # A user who writes to the bot again has unblocked it
+            is_deleted=False,
+        ))
+    # The upsert cannot tell inserted rows from updated ones, so existing users are read first
+    existing = dict(User.objects.filter(id__in=[user.id for user in users]).values_list('id', 'is_deleted'))
+    new_users = len(buffer) - len(existing)
+    unblocked = sum(existing.values())
+    try:
+        User.objects.bulk_create(users, batch_size=settings.ACTIVITY_FLUSH_BATCH_SIZE, update_conflicts=True,
+                                 unique_fields=['id'], update_fields=UPDATE_FIELDS)
+    except Exception:
+        # Put the batch back without overwriting anything recorded since it was taken
+        with client.pipeline(transaction=False) as pipe:
+            for user_id, value in buffer.items():
+                pipe.hsetnx(BUFFER_KEY, user_id, value)
+            pipe.execute()
+        raise
+    if new_users or unblocked:
+        stats.record_users(new=new_users, blocked=-unblocked)
+    logging.info(f'User activity flushed for {len(users)} users, {new_users} new, {unblocked} unblocked the bot')
+    return len(users)
@@ -1,10 +1,24 @@
 from django.contrib import admin
-from bot.models import Doctor, Speciality, Polyclinic, District, Position, Schedule, Phone, Address, Share
-from django.utils.html import mark_safe
-from bot.forms import PolyclinicForm, DoctorForm, ShareForm
+from django.contrib.admin.views.main import ChangeList
+from bot.models import Doctor, Speciality, Polyclinic, District, Position, Schedule, Phone, Address, Share, \
+    DailyStats, SearchStats
+from django.utils.html import mark_safe, format_html, escape
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db.models import Q, Value
+from django.db.models.functions import Concat
+from bot.forms import PolyclinicForm, DoctorForm, ShareForm, ImportForm
 from django.utils.translation import gettext_lazy as _
 import re
 from bot.filters import SpecialityFilter
+from bot.tasks import broadcast_share
+from bot import broadcast, ranking, index, copying, importing, exporting
+from django.contrib import messages
+from django.core.exceptions import PermissionDenied
+from django.shortcuts import redirect
+from django.http import StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.urls import path
+from datetime import datetime
 
 
 admin.site.site_header = _('DOCTOR BOT')
@@ -12,9 +26,102 @@ admin.site.site_title = _('DOCTOR BOT')
 admin.site.index_title = _('DOCTOR BOT')
 
 
+class ImportMixin():
+    directory_kind = None
+    import_errors_shown = 50
+    change_list_template = 'admin/bot/change_list_import.html'
+
+    def get_urls(self):
+        opts = self.model._meta
+        urls = [path('import/', self.admin_site.admin_view(self.import_view),
+                     name=f'{opts.app_label}_{opts.model_name}_import')]
+        return urls + super().get_urls()
+
+    def import_view(self, request):
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            upload = form.cleaned_data['file']
+            report = importing.import_file(self.directory_kind, upload.file, upload.name)
+            level = messages.WARNING if report.errors else messages.SUCCESS
+            self.message_user(request, _('Created %(created)s, updated %(updated)s, rows with errors %(failed)s') % {
+                'created': report.created, 'updated': report.updated, 'failed': len(report.errors)}, level)
+            for number, message in report.errors[:self.import_errors_shown]:
+                self.message_user(request, _('Row %(number)s: %(message)s') % {'number': number, 'message': message},
+                                  messages.ERROR)
+            opts = self.model._meta
+            return redirect(f'admin:{opts.app_label}_{opts.model_name}_changelist')
+        model, columns, _index_keys = importing.KINDS[self.directory_kind]
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': _('Import'),
+            'form': form,
+            'columns': ['id', *columns],
+            'separator': importing.LIST_SEPARATOR,
+        }
+        return TemplateResponse(request, 'admin/bot/import.html', context)
+
+
+class ExportMixin():
+    directory_kind = None
+
+    def export_response(self, queryset, format):
+        lines = exporting.export_lines(self.directory_kind, format, queryset)
+        response = StreamingHttpResponse(exporting.aiterate(lines), content_type=exporting.CONTENT_TYPES[format])
+        response['Content-Disposition'] = f'attachment; filename="{self.directory_kind}.{format}"'
+        return response
+
+    def export_csv(self, request, queryset):
+        return self.export_response(queryset, 'csv')
+    export_csv.short_description = _('Export chosen records to CSV')
+
+    def export_jsonl(self, request, queryset):
+        return self.export_response(queryset, 'jsonl')
+    export_jsonl.short_description = _('Export chosen records to JSON lines')
+
+
+def polyclinics_tag(polyclinics):
+    # polyclinics is annotated by PolyclinicsMixin, an unsaved object has none
+    if not polyclinics:
+        return '-'
+    return format_html('<span>{}</span>', mark_safe(',<br>'.join(escape(i) for i in polyclinics)))
+
+
+class PolyclinicsChangeList(ChangeList):
+    def get_queryset(self, request):
+        return self.model_admin.with_polyclinics(super().get_queryset(request))
+
+
+class PolyclinicsMixin():
+    # The polyclinics list is aggregated for the changelist and the change form
+    # only; the autocomplete of the polyclinic form also uses get_queryset and
+    # must not pay for the GROUP BY on every keystroke
+    polyclinics_aggregate = None
+
+    def with_polyclinics(self, queryset):
+        return queryset.annotate(polyclinics=self.polyclinics_aggregate)
+
+    def get_changelist(self, request, **kwargs):
+        return PolyclinicsChangeList
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            obj.polyclinics = self.with_polyclinics(type(obj).objects.filter(pk=obj.pk)) \
+                .values_list('polyclinics', flat=True).get()
+        return obj
+
+    def _polyclinic(self, obj):
+        return polyclinics_tag(getattr(obj, 'polyclinics', None))
+    _polyclinic.short_description = _('Polyclinic')
+
+
 @admin.register(Doctor)
-class DoctorAdmin(admin.ModelAdmin):
+class DoctorAdmin(ImportMixin, ExportMixin, admin.ModelAdmin):
     form = DoctorForm
+    directory_kind = 'doctors'
     list_per_page = 50
     autocomplete_fields = ('polyclinic', 'district', 'schedule')
     list_display = ('id', 'last_name', 'first_name', 'paternal_name', 'phone',
@@ -27,68 +134,62 @@ class DoctorAdmin(admin.ModelAdmin):
               'schedule', 'experience', 'cost')
     readonly_fields = ('image_tag',)
     list_display_links = ('last_name', 'first_name', 'paternal_name')
-    actions = ('copy_action',)
+    actions = ('copy_action', 'export_csv', 'export_jsonl')
 
     def image_tag(self, obj):
         return mark_safe(f'<img src="{obj.image.url}" width="50" height="50" />')
     image_tag.short_description = 'Photo'
 
     def save_model(self, request, obj, form, change):
-        if obj.rating:
-            doctors = Doctor.objects.filter(rating=obj.rating).all()
-            for i in doctors:
-                i.rating = None
-                i.save()
+        holders_id = ranking.take_rating(obj)
         super().save_model(request, obj, form, change)
+        # update() sends no signals, the result lists the previous holders were in are rebuilt here
+        index.rebuild_on_commit(doctors_id=holders_id)
 
     def copy_action(self, request, queryset):
-        for obj in queryset:
-            previous_polyclinic = obj.polyclinic.all()
-            previous_district = obj.district.all()
-            previous_schedule = obj.schedule.all()
-            obj.id = None
-            obj.save()
-            obj.polyclinic.set(previous_polyclinic)
-            obj.district.set(previous_district)
-            obj.schedule.set(previous_schedule)
+        # Copies are identical apart from the id, so the search vector is copied as
+        # is; the rating slot stays with the original
+        doctors_id = copying.bulk_copy(queryset, ('polyclinic', 'district', 'schedule'), reset_fields=('rating',))
+        index.rebuild_on_commit(doctors_id=doctors_id)
         self.message_user(request, _('Selected records were copied successfully'))
     copy_action.short_description = _('Copy chosen records')
 
 
 @admin.register(Polyclinic)
-class PolyclinicAdmin(admin.ModelAdmin):
+class PolyclinicAdmin(ImportMixin, ExportMixin, admin.ModelAdmin):
     form = PolyclinicForm
+    directory_kind = 'polyclinics'
     list_per_page = 50
     list_filter = (SpecialityFilter, 'district')
     autocomplete_fields = ('speciality', 'phone', 'address')
     list_display = ('id', 'name', 'addresses', 'district', 'site', 'phones',
                     'work_time', 'rating', 'image_tag')
+    # district is nullable, the automatic select_related() of the changelist skips it
+    list_select_related = ('district',)
     search_fields = ('name',)
     fields = ('name', 'address', 'site_url', 'phone', 'rating', 'image_tag',
               'image', 'district', 'speciality', 'work_time_start', 'work_time_end')
     readonly_fields = ('image_tag',)
     list_display_links = ('name',)
-    actions = ('copy_action',)
+    actions = ('copy_action', 'export_csv', 'export_jsonl')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('address', 'phone')
 
     def image_tag(self, obj):
         return mark_safe(f'<img src="{obj.image.url}" width="50" height="50" />')
     image_tag.short_description = _('Photo')
 
     def phones(self, obj):
-        if obj.phone.exists():
-            text = ', '.join([i.number for i in obj.phone.all()])
-            return text
-        else:
-            return '-'
+        text = ', '.join([i.number for i in obj.phone.all()])
+        return text or '-'
     phones.short_description = _('Phone numbers')
 
     def save_model(self, request, obj, form, change):
-        if obj.rating:
-            polyclinics = Polyclinic.objects.filter(rating=obj.rating).all()
-            for i in polyclinics:
-                i.rating = None
-                i.save()
+        holders_id = ranking.take_rating(obj)
         super().save_model(request, obj, form, change)
+        # update() sends no signals, the result lists the previous holders were in are rebuilt here
+        index.rebuild_on_commit(polyclinics_id=holders_id)
 
     def site(self, obj):
         if obj.site_url:
@@ -98,23 +199,13 @@ class PolyclinicAdmin(admin.ModelAdmin):
     site.short_description = _('Site URL')
 
     def addresses(self, obj):
-        if obj.address.exists():
-            text = ', '.join([i.name for i in obj.address.all()])
-            return text
-        else:
-            return '-'
+        text = ', '.join([i.name for i in obj.address.all()])
+        return text or '-'
     addresses.short_description = _('Addresses')
 
     def copy_action(self, request, queryset):
-        for obj in queryset:
-            previous_address = obj.address.all()
-            previous_phone = obj.phone.all()
-            previous_speciality = obj.speciality.all()
-            obj.id = None
-            obj.save()
-            obj.address.set(previous_address)
-            obj.phone.set(previous_phone)
-            obj.speciality.set(previous_speciality)
+        polyclinics_id = copying.bulk_copy(queryset, ('address', 'phone', 'speciality'), reset_fields=('rating',))
+        index.rebuild_on_commit(polyclinics_id=polyclinics_id)
         self.message_user(request, _('Selected records were copied successfully'))
     copy_action.short_description = _('Copy chosen records')
 
@@ -123,17 +214,31 @@ class PolyclinicAdmin(admin.ModelAdmin):
 class ShareAdmin(admin.ModelAdmin):
     form = ShareForm
     list_display_links = ('name',)
-    list_display = ('id', 'name', 'start_date', 'end_date', 'sum', 'rating', 'image_tag')
+    list_display = ('id', 'name', 'start_date', 'end_date', 'sum', 'rating', 'image_tag', 'broadcast_progress')
     search_fields = ('name',)
-    fields = ('name', 'description', 'start_date', 'end_date', 'sum', 'rating', 'image_tag', 'image')
-    readonly_fields = ('image_tag',)
+    fields = ('name', 'description', 'start_date', 'end_date', 'sum', 'rating', 'image_tag', 'image',
+              'broadcast_progress')
+    readonly_fields = ('image_tag', 'broadcast_progress')
+    actions = ('broadcast_action',)
+
+    def broadcast_progress(self, obj):
+        progress = broadcast.get_progress(obj.id) if obj.id else None
+        if not progress:
+            return '-'
+        return _('%(done)s of %(queued)s, sent %(sent)s, blocked %(blocked)s, '
+                 'failed %(failed)s, %(rate).1f msg/s') % progress
+    broadcast_progress.short_description = _('Broadcast')
+
+    def broadcast_action(self, request, queryset):
+        shares = queryset.filter(end_date__gte=datetime.today().date())
+        for share in shares:
+            broadcast_share.delay(share.id)
+        self.message_user(request, _('Broadcast started for %(count)s active shares') % {'count': len(shares)})
+    broadcast_action.short_description = _('Broadcast chosen shares to all users')
 
     def save_model(self, request, obj, form, change):
-        if obj.rating:
-            shares = Share.objects.filter(rating=obj.rating).all()
-            for i in shares:
-                i.rating = None
-                i.save()
+        # Shares are sorted by rating when the button is pressed, nothing cached depends on it
+        ranking.take_rating(obj)
         super().save_model(request, obj, form, change)
 
     def image_tag(self, obj):
@@ -142,11 +247,13 @@ class ShareAdmin(admin.ModelAdmin):
 
 
 @admin.register(Phone)
-class PhoneAdmin(admin.ModelAdmin):
+class PhoneAdmin(PolyclinicsMixin, admin.ModelAdmin):
     list_display = ('number', '_polyclinic')
     search_fields = ('number',)
     fields = ('number', '_polyclinic')
     readonly_fields = ('_polyclinic',)
+    polyclinics_aggregate = ArrayAgg(Concat('polyclinic__name', Value(' - '), 'polyclinic__address__name'),
+                                     filter=Q(polyclinic__isnull=False), ordering='polyclinic__name')
 
     # def get_search_results(self, request, queryset, search_term):
     #     queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
@@ -157,32 +264,14 @@ class PhoneAdmin(admin.ModelAdmin):
     #             queryset = queryset.filter(polyclinic=polyclinic_id).order_by('-id')
     #     return queryset, may_have_duplicates
 
-    def _polyclinic(self, obj):
-        if obj.id:
-            polyclinics = Polyclinic.objects.filter(phone__id=obj.id).values('name', 'address__name')
-            if polyclinics:
-                polyclinic_address = [f'{i["name"]} - {i["address__name"]}' for i in polyclinics]
-                text = ',<br>'.join(polyclinic_address)
-                return mark_safe(f'<span>{text}</span>')
-        return '-'
-    _polyclinic.short_description = _('Polyclinic')
-
 
 @admin.register(Address)
-class AddressAdmin(admin.ModelAdmin):
+class AddressAdmin(PolyclinicsMixin, admin.ModelAdmin):
     list_display = ('name', '_polyclinic')
     search_fields = ('name',)
     fields = ('name', '_polyclinic')
     readonly_fields = ('_polyclinic',)
-
-    def _polyclinic(self, obj):
-        if obj.id:
-            polyclinics = Polyclinic.objects.filter(address__id=obj.id).values_list('name', flat=True)
-            if polyclinics:
-                text = ',<br>'.join(polyclinics)
-                return mark_safe(f'<span>{text}</span>')
-        return '-'
-    _polyclinic.short_description = _('Polyclinic')
+    polyclinics_aggregate = ArrayAgg('polyclinic__name', filter=Q(polyclinic__isnull=False), ordering='polyclinic__name')
 
 
 @admin.register(District)
@@ -198,12 +287,54 @@ class PositionAdmin(admin.ModelAdmin):
 
 
 @admin.register(Schedule)
-class ScheduleAdmin(admin.ModelAdmin):
+class ScheduleAdmin(ImportMixin, ExportMixin, admin.ModelAdmin):
+    directory_kind = 'schedules'
+    actions = ('export_csv', 'export_jsonl')
     list_display = ('day_of_week', 'start_time', 'end_time', 'polyclinic')
     search_fields = ('day_of_week', 'start_time', 'end_time', 'polyclinic')
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('polyclinic').prefetch_related('polyclinic__address')
+
 
 @admin.register(Speciality)
 class SpecialityAdmin(admin.ModelAdmin):
     list_display = ('name',)
     search_fields = ('name',)
+
+
+class ReadOnlyStatsAdmin(admin.ModelAdmin):
+    list_per_page = 50
+    date_hierarchy = 'date'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def not_found_rate(self, obj):
+        return f'{obj.not_found / obj.searches:.0%}' if obj.searches else '-'
+    not_found_rate.short_description = _('Not found rate')
+
+    def average_results(self, obj):
+        return f'{obj.results / obj.searches:.1f}' if obj.searches else '-'
+    average_results.short_description = _('Average results')
+
+
+@admin.register(DailyStats)
+class DailyStatsAdmin(ReadOnlyStatsAdmin):
+    list_display = ('date', 'users_total', 'users_blocked', 'new_users', 'active_users', 'searches',
+                    'not_found', 'not_found_rate', 'average_results', 'directory_searches', 'directory_not_found')
+
+
+@admin.register(SearchStats)
+class SearchStatsAdmin(ReadOnlyStatsAdmin):
+    list_display = ('date', 'clinic_or_private', 'speciality', 'district', 'searches',
+                    'not_found', 'not_found_rate', 'average_results')
+    list_filter = ('date', 'clinic_or_private', SpecialityFilter, 'district')
+    list_select_related = ('speciality', 'district')
+    ordering = ('-date', '-searches')
@@ -0,0 +1,39 @@
+import time
+from django.core.cache import cache
+
+
+# Progress of the last broadcast of every share. Batches add to the counters as
+# they finish, so the admin can show how far a send is while it is running.
+
+COUNTERS = ('queued', 'sent', 'blocked', 'failed')
+
+
+def progress_key(share_id, name):
+    return f'broadcast_{share_id}_{name}'
+
+
+def start(share_id):
+    now = time.time()
+    values = {progress_key(share_id, name): 0 for name in COUNTERS}
+    values[progress_key(share_id, 'started')] = now
+    values[progress_key(share_id, 'updated')] = now
+    cache.set_many(values)
+
+
+def add(share_id, **counters):
+    for name, value in counters.items():
+        if value:
+            cache.incr(progress_key(share_id, name), value)
+    cache.set(progress_key(share_id, 'updated'), time.time())
+
+
+def get_progress(share_id):
+    names = COUNTERS + ('started', 'updated')
+    values = cache.get_many([progress_key(share_id, name) for name in names])
+    if not values:
+        return None
+    progress = {name: values.get(progress_key(share_id, name), 0) for name in names}
+    progress['done'] = progress['sent'] + progress['blocked'] + progress['failed']
+    elapsed = progress['updated'] - progress['started']
+    progress['rate'] = progress['done'] / elapsed if elapsed > 0 else 0
+    return progress
@@ -0,0 +1,66 @@
+import re
+
+
+# Compact callback_data format: <version><type tag><base-36 ids joined by '.'>,
+# e.g. '2sc' is speciality 12. Every button carries all choices of the search
+# it belongs to, after the speciality they start with the clinic_or_private
+# index: '2c1.c' is private for speciality 12 and '2m1.c.3.5' the "more"
+# button of district 3 at offset 5. Telegram allows 64 bytes, which fits
+# four ids of any BigAutoField value.
+
+VERSION = '2'
+MAX_LENGTH = 64
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+TYPES = {
+    'speciality': 's',
+    'clinic_or_private': 'c',
+    'district': 'd',
+    'more': 'm',
+}
+TAGS = {tag: type for type, tag in TYPES.items()}
+VALUE = re.compile('[0-9a-z]+')
+LENGTHS = {
+    'speciality': 1,
+    'clinic_or_private': 2,
+    'district': 3,
+    'more': 4,
+}
+
+CLINIC_OR_PRIVATE = ('clinic', 'private')
+
+
+def to_base36(value):
+    if value < 0:
+        raise ValueError(f'Negative id {value} in callback data')
+    digits = ''
+    while True:
+        value, digit = divmod(value, 36)
+        digits = DIGITS[digit] + digits
+        if not value:
+            return digits
+
+
+def encode(type, *values):
+    data = VERSION + TYPES[type] + '.'.join(to_base36(value) for value in values)
+    if len(data) > MAX_LENGTH:
+        raise ValueError(f'Callback data {data} is longer than {MAX_LENGTH} bytes')
+    return data
+
+
+def decode(data):
+    if not data or data[0] != VERSION or len(data) < 3:
+        raise ValueError(f'Unsupported callback data {data!r}')
+    type = TAGS.get(data[1])
+    if type is None:
+        raise ValueError(f'Unknown callback type in {data!r}')
+    values = data[2:].split('.')
+    # int() would also take a sign, whitespace or underscores
+    if not all(VALUE.fullmatch(value) for value in values):
+        raise ValueError(f'Malformed values in {data!r}')
+    values = [int(value, 36) for value in values]
+    if len(values) != LENGTHS[type]:
+        raise ValueError(f'Expected {LENGTHS[type]} values in {data!r}')
+    if type != 'speciality' and values[0] >= len(CLINIC_OR_PRIVATE):
+        raise ValueError(f'Unknown clinic_or_private value in {data!r}')
+    return type, values
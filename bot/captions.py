@@ -0,0 +1,123 @@
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q, Prefetch
+from bot.models import Doctor, Polyclinic, Share, Schedule
+
+
+def version_key(kind, id):
+    return f'caption_version_{kind}_{id}'
+
+
+def caption_key(kind, version, id):
+    return f'caption_{kind}_{version}_{id}'
+
+
+def render_doctor(doctor):
+    full_name = f'<b>{doctor.full_name}\n</b>'
+    if doctor.speciality:
+        speciality = f'{doctor.speciality._meta.verbose_name}: <i>{doctor.speciality.name}\n</i>'
+    else:
+        speciality = ''
+    if doctor.position:
+        position = f'{doctor.position._meta.verbose_name}: <i>{doctor.position.name}\n</i>'
+    else:
+        position = ''
+    polyclinics = f'{doctor.polyclinic.model._meta.verbose_name_plural}:\n'
+    for i in doctor.polyclinic.all():
+        polyclinics += f'<i>{i}</i>\n'
+    experience = f'{doctor._meta.get_field("experience").verbose_name}: <i>{doctor.experience} лет</i>\n'
+    cost = f'{doctor._meta.get_field("cost").verbose_name}: <i>{doctor.cost} грн.</i>\n'
+    schedules = f'{doctor.schedule.model._meta.verbose_name}:\n'
+    for schedule in doctor.schedule.all():
+        schedules += f'<i>{schedule}</i>\n'
+    phone = f'{doctor._meta.get_field("phone").verbose_name}:\n <i>{doctor.phone}</i>\n'
+    return full_name + speciality + position + polyclinics + experience + cost + schedules + phone
+
+
+def render_polyclinic(polyclinic):
+    name = f'<b>{polyclinic.name}\n</b>'
+    addresses = f'{polyclinic.address.model._meta.verbose_name}:\n'
+    for address in polyclinic.address.all():
+        addresses += f'<i>{address.name}</i>\n'
+    phones = f'{polyclinic.phone.model._meta.verbose_name}:\n'
+    for phone in polyclinic.phone.all():
+        phones += f'<i>{phone.number}</i>\n'
+    url = polyclinic.site_url if polyclinic.site_url else ''
+    site = f'{polyclinic._meta.get_field("site_url").verbose_name}: <a href="{url}">{url}</a>\n'
+    work_time = f'{polyclinic.work_time.short_description}: <i>{polyclinic.work_time()}</i>\n'
+    return name + addresses + site + work_time + phones
+
+
+def render_share(share):
+    name = f'<b>{share.name}\n</b>'
+    start_date = f'{share._meta.get_field("start_date").verbose_name}: <i>{share.start_date:%d.%m.%Y}</i>\n'
+    end_date = f'{share._meta.get_field("end_date").verbose_name}: <i>{share.end_date:%d.%m.%Y}</i>\n'
+    description = f'{share.description}\n'
+    if share.sum:
+        sum = f'{share._meta.get_field("sum").verbose_name}: <i>{share.sum} грн.</i>\n'
+    else:
+        sum = ''
+    return name + description + start_date + end_date + sum
+
+
+CARDS = {
+    'doctor': (
+        lambda ids: (Doctor.objects
+                     .select_related('speciality', 'position')
+                     .prefetch_related(
+                         Prefetch('polyclinic', queryset=Polyclinic.objects.prefetch_related('address')),
+                         Prefetch('schedule', queryset=Schedule.objects
+                                  .select_related('polyclinic')
+                                  .prefetch_related('polyclinic__address')),
+                     )
+                     .filter(id__in=ids)),
+        render_doctor,
+    ),
+    'polyclinic': (
+        lambda ids: (Polyclinic.objects
+                     .prefetch_related('phone', 'address')
+                     .filter(id__in=ids)),
+        render_polyclinic,
+    ),
+    'share': (
+        lambda ids: Share.objects.filter(id__in=ids),
+        render_share,
+    ),
+}
+
+
+def get_cards(kind, ids):
+    # Returns (image_name, caption) pairs in the order of ids, rendering and
+    # caching only the objects that have no caption stored yet. Every object
+    # has a version that invalidate() replaces on commit; a caption rendered
+    # from rows read before the commit is stored under the old version, so no
+    # reader gets it afterwards.
+    versions = cache.get_many([version_key(kind, id) for id in ids])
+    keys = {caption_key(kind, versions.get(version_key(kind, id), 0), id): id for id in ids}
+    cards = cache.get_many(keys)
+    missing = {id: key for key, id in keys.items() if key not in cards}
+    if missing:
+        queryset, render = CARDS[kind]
+        rendered = {missing[obj.id]: (obj.image.name, render(obj)) for obj in queryset(list(missing))}
+        cache.set_many(rendered, settings.CAPTION_TTL)
+        cards.update(rendered)
+    return [cards[key] for key in keys if key in cards]
+
+
+def invalidate(doctors_id=(), polyclinics_id=(), shares_id=()):
+    # Doctor captions print their polyclinics and schedules (with the schedule's
+    # polyclinic), so a changed polyclinic invalidates those doctors as well.
+    # Captions of a replaced version expire after CAPTION_TTL.
+    doctors_id = set(doctors_id)
+    polyclinics_id = set(polyclinics_id)
+    if polyclinics_id:
+        doctors_id |= set(Doctor.objects
+                          .filter(Q(polyclinic__in=polyclinics_id) | Q(schedule__polyclinic__in=polyclinics_id))
+                          .values_list('id', flat=True))
+    keys = [version_key('doctor', id) for id in doctors_id]
+    keys += [version_key('polyclinic', id) for id in polyclinics_id]
+    keys += [version_key('share', id) for id in shares_id]
+    if keys:
+        transaction.on_commit(lambda: cache.set_many(dict.fromkeys(keys, time.time_ns()), None))
@@ -0,0 +1,31 @@
+from django.db import transaction
+
+
+def bulk_copy(queryset, m2m_fields, reset_fields=()):
+    # Inserts the copies with one bulk_create and copies every m2m relation
+    # with one read and one bulk insert of its through table, so the number of
+    # queries does not depend on how many rows are copied. No signals are
+    # sent; returns the new ids for the caller to reindex.
+    model = queryset.model
+    originals = list(queryset.order_by('pk'))
+    if not originals:
+        return []
+    originals_id = [obj.pk for obj in originals]
+    with transaction.atomic():
+        for obj in originals:
+            obj.pk = None
+            obj._state.adding = True
+            for name in reset_fields:
+                setattr(obj, name, None)
+        copies = model.objects.bulk_create(originals)
+        copy_of = {original_id: copy.pk for original_id, copy in zip(originals_id, copies)}
+
+        for name in m2m_fields:
+            field = model._meta.get_field(name)
+            through = field.remote_field.through
+            source = f'{field.m2m_field_name()}_id'
+            target = f'{field.m2m_reverse_field_name()}_id'
+            rows = through.objects.filter(**{f'{source}__in': originals_id}).values_list(source, target)
+            through.objects.bulk_create([through(**{source: copy_of[source_id], target: target_id})
+                                         for source_id, target_id in rows])
+    return list(copy_of.values())
@@ -4,3 +4,13 @@ class ResponseException(Exception):
 
 class TelegramException(Exception):
     pass
+
+
+class RetryAfterException(ResponseException):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class BlockedException(ResponseException):
+    pass
@@ -0,0 +1,110 @@
+import csv
+import json
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from bot.models import Doctor, Polyclinic, Schedule
+from bot.importing import LIST_SEPARATOR, DOCTOR_COLUMNS, POLYCLINIC_COLUMNS, SCHEDULE_COLUMNS
+
+
+# Directory export as CSV or JSON lines, with the columns import reads, so an
+# exported file can be edited and imported back. Rows are read in pages of
+# ids greater than the last one seen, each page with its relations
+# prefetched, and written out one line at a time. Keyset pages keep memory
+# flat without server-side cursors, which are off behind pgbouncer.
+
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+
+def clock(value):
+    return f'{value:%H:%M}' if value else ''
+
+
+def doctor_row(doctor):
+    return {
+        'id': doctor.id,
+        'last_name': doctor.last_name,
+        'first_name': doctor.first_name,
+        'paternal_name': doctor.paternal_name,
+        'phone': doctor.phone,
+        'speciality': doctor.speciality.name if doctor.speciality else '',
+        'position': doctor.position.name if doctor.position else '',
+        'experience': doctor.experience,
+        'cost': doctor.cost,
+        'rating': doctor.rating or '',
+        'districts': [district.name for district in doctor.district.all()],
+        'polyclinics': [polyclinic.name for polyclinic in doctor.polyclinic.all()],
+        'schedules': [schedule.id for schedule in doctor.schedule.all()],
+        'image': doctor.image.name,
+    }
+
+
+def polyclinic_row(polyclinic):
+    return {
+        'id': polyclinic.id,
+        'name': polyclinic.name,
+        'addresses': [address.name for address in polyclinic.address.all()],
+        'phones': [phone.number for phone in polyclinic.phone.all()],
+        'specialities': [speciality.name for speciality in polyclinic.speciality.all()],
+        'site_url': polyclinic.site_url or '',
+        'work_time_start': clock(polyclinic.work_time_start),
+        'work_time_end': clock(polyclinic.work_time_end),
+        'district': polyclinic.district.name if polyclinic.district else '',
+        'rating': polyclinic.rating or '',
+        'image': polyclinic.image.name,
+    }
+
+
+def schedule_row(schedule):
+    return {
+        'id': schedule.id,
+        'polyclinic': schedule.polyclinic.name if schedule.polyclinic else '',
+        'day_of_week': schedule.day_of_week,
+        'start_time': clock(schedule.start_time),
+        'end_time': clock(schedule.end_time),
+    }
+
+
+# kind -> (model, columns, select_related, prefetch_related, row)
+EXPORTS = {
+    'doctors': (Doctor, DOCTOR_COLUMNS, ('speciality', 'position'), ('district', 'polyclinic', 'schedule'), doctor_row),
+    'polyclinics': (Polyclinic, POLYCLINIC_COLUMNS, ('district',), ('address', 'phone', 'speciality'), polyclinic_row),
+    'schedules': (Schedule, SCHEDULE_COLUMNS, ('polyclinic',), (), schedule_row),
+}
+
+
+class Echo():
+    # csv.writer writes into this and gets the formatted line back
+    def write(self, value):
+        return value
+
+
+def export_lines(kind, format, queryset=None):
+    model, columns, select, prefetch, build = EXPORTS[kind]
+    if queryset is None:
+        queryset = model.objects.all()
+    queryset = queryset.select_related(*select).prefetch_related(*prefetch).order_by('id')
+    header = ['id', *columns]
+    writer = csv.writer(Echo())
+    if format == 'csv':
+        yield writer.writerow(header)
+    last_id = 0
+    while page := list(queryset.filter(id__gt=last_id)[:settings.EXPORT_CHUNK_SIZE]):
+        last_id = page[-1].id
+        for obj in page:
+            row = build(obj)
+            if format == 'csv':
+                yield writer.writerow([LIST_SEPARATOR.join(map(str, row[column])) if isinstance(row[column], list)
+                                       else row[column] for column in header])
+            else:
+                yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+async def aiterate(lines):
+    # Django 4.2 under ASGI reads a sync iterator to the end before sending the
+    # first byte, so lines are pulled in batches from the thread the ORM runs in
+    def next_batch():
+        return ''.join(islice(lines, settings.EXPORT_CHUNK_SIZE))
+    while batch := await sync_to_async(next_batch)():
+        yield batch
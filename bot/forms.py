@@ -3,6 +3,7 @@ from bot.models import Doctor, Polyclinic, Phone, Address, Schedule, Share
 from django.contrib.admin.widgets import AutocompleteSelectMultiple
 from django.contrib import admin
 from django.utils.translation import gettext_lazy as _
+from django.core.validators import FileExtensionValidator
 
 
 class PolyclinicForm(forms.ModelForm):
@@ -27,7 +28,7 @@ class DoctorForm(forms.ModelForm):
 
     schedule = forms.ModelMultipleChoiceField(
         label=_('Schedule'),
-        queryset=Schedule.objects.all(),
+        queryset=Schedule.objects.select_related('polyclinic').prefetch_related('polyclinic__address'),
         required=True,
         widget=AutocompleteSelectMultiple(
             Doctor.schedule.field,
@@ -38,7 +39,7 @@ class DoctorForm(forms.ModelForm):
 
     polyclinic = forms.ModelMultipleChoiceField(
         label=_('Polyclinic'),
-        queryset=Polyclinic.objects.all(),
+        queryset=Polyclinic.objects.prefetch_related('address'),
         required=True,
         widget=AutocompleteSelectMultiple(
             Doctor.polyclinic.field,
@@ -62,3 +63,7 @@ class ShareForm(forms.ModelForm):
     class Meta:
         model = Share
         fields = '__all__'
+
+
+class ImportForm(forms.Form):
+    file = forms.FileField(label=_('File'), validators=[FileExtensionValidator(['csv', 'xlsx'])])
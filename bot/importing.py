@@ -0,0 +1,393 @@
+import io
+import csv
+import logging
+from itertools import islice
+from datetime import datetime, time
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from bot.models import Doctor, Polyclinic, Schedule, Speciality, District, Position, Address, Phone, RATING
+from bot import index, search, captions, ranking
+
+
+# Directory import from CSV or XLSX, with the columns the export writes.
+# Relations are given by name, several names in one cell are separated by
+# LIST_SEPARATOR; doctors' schedules are given by id. A row with an id updates
+# that record, a row without one creates a new record, and a column missing
+# from the file leaves that field untouched. Rows are written in chunks with
+# bulk queries, which send no signals, so the result lists, search vectors and
+# captions of everything imported are refreshed once at the end.
+
+LIST_SEPARATOR = ';'
+
+
+def name_key(name):
+    return ' '.join(name.lower().split())
+
+
+def parse_list(value):
+    return list(dict.fromkeys(item.strip() for item in value.split(LIST_SEPARATOR) if item.strip()))
+
+
+def parse_text(value, lookups):
+    return value
+
+
+def parse_int(value, lookups):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError(f'"{value}" is not a whole number')
+
+
+def parse_float(value, lookups):
+    try:
+        return float(value.replace(',', '.'))
+    except ValueError:
+        raise ValidationError(f'"{value}" is not a number')
+
+
+def parse_rating(value, lookups):
+    if value not in dict(RATING):
+        raise ValidationError(f'"{value}" is not a rating from 1 to 5')
+    return value
+
+
+def parse_time(value, lookups):
+    for format in ('%H:%M', '%H:%M:%S'):
+        try:
+            return datetime.strptime(value, format).time()
+        except ValueError:
+            pass
+    raise ValidationError(f'"{value}" is not a time like 09:00')
+
+
+def parse_schedules(value, lookups):
+    schedules_id = [parse_int(item, lookups) for item in parse_list(value)]
+    unknown = [str(id) for id in schedules_id if id not in lookups.schedules]
+    if unknown:
+        raise ValidationError(f'no schedules with id {", ".join(unknown)}')
+    return schedules_id
+
+
+def lookup(attribute):
+    def parse(value, lookups):
+        return lookups.get(attribute, value)
+    return parse
+
+
+def lookup_list(attribute):
+    def parse(value, lookups):
+        return [lookups.get(attribute, name) for name in parse_list(value)]
+    return parse
+
+
+def lookup_contacts(attribute):
+    # Addresses and phone numbers are given as text and may be new, they are
+    # resolved to ids in the transaction of their chunk, see Lookups.add_contacts
+    def parse(value, lookups):
+        return [lookups.contact(attribute, name) for name in parse_list(value)]
+    return parse
+
+
+def parse_polyclinic(value, lookups):
+    polyclinics_id = lookups.polyclinics.get(name_key(value), [])
+    if len(polyclinics_id) > 1:
+        raise ValidationError(f'"{value}" matches {len(polyclinics_id)} polyclinics, rename them to tell them apart')
+    if not polyclinics_id:
+        raise ValidationError(f'"{value}" not found')
+    return polyclinics_id[0]
+
+
+def parse_polyclinics(value, lookups):
+    return [parse_polyclinic(name, lookups) for name in parse_list(value)]
+
+
+# column -> (model field, parser); a parser gets a non-empty cell
+DOCTOR_COLUMNS = {
+    'last_name': ('last_name', parse_text),
+    'first_name': ('first_name', parse_text),
+    'paternal_name': ('paternal_name', parse_text),
+    'phone': ('phone', parse_text),
+    'speciality': ('speciality', lookup('specialities')),
+    'position': ('position', lookup('positions')),
+    'experience': ('experience', parse_int),
+    'cost': ('cost', parse_float),
+    'rating': ('rating', parse_rating),
+    'districts': ('district', lookup_list('districts')),
+    'polyclinics': ('polyclinic', parse_polyclinics),
+    'schedules': ('schedule', parse_schedules),
+    'image': ('image', parse_text),
+}
+
+POLYCLINIC_COLUMNS = {
+    'name': ('name', parse_text),
+    'addresses': ('address', lookup_contacts('addresses')),
+    'phones': ('phone', lookup_contacts('phones')),
+    'specialities': ('speciality', lookup_list('specialities')),
+    'site_url': ('site_url', parse_text),
+    'work_time_start': ('work_time_start', parse_time),
+    'work_time_end': ('work_time_end', parse_time),
+    'district': ('district', lookup('districts')),
+    'rating': ('rating', parse_rating),
+    'image': ('image', parse_text),
+}
+
+SCHEDULE_COLUMNS = {
+    'polyclinic': ('polyclinic', parse_polyclinic),
+    'day_of_week': ('day_of_week', parse_text),
+    'start_time': ('start_time', parse_time),
+    'end_time': ('end_time', parse_time),
+}
+
+
+class Lookups():
+    # Name -> id maps of everything rows refer to, loaded once per import.
+    # Addresses and phone numbers that do not exist yet are created with the
+    # chunk that gives them, only for rows that passed validation.
+    CONTACTS = {'addresses': (Address, 'name'), 'phones': (Phone, 'number')}
+
+    def __init__(self):
+        self.specialities = self.load(Speciality.objects, 'name')
+        self.districts = self.load(District.objects, 'name')
+        self.positions = self.load(Position.objects, 'name')
+        self.addresses = self.load(Address.objects, 'name')
+        self.phones = self.load(Phone.objects, 'number')
+        self.polyclinics = {}
+        for id, name in Polyclinic.objects.values_list('id', 'name'):
+            self.polyclinics.setdefault(name_key(name), []).append(id)
+        self.schedules = set(Schedule.objects.values_list('id', flat=True))
+
+    @staticmethod
+    def load(queryset, field):
+        return {name_key(name): id for id, name in queryset.values_list('id', field)}
+
+    def get(self, attribute, name):
+        id = getattr(self, attribute).get(name_key(name))
+        if id is None:
+            raise ValidationError(f'"{name}" not found')
+        return id
+
+    def contact(self, attribute, name):
+        model, field = self.CONTACTS[attribute]
+        max_length = model._meta.get_field(field).max_length
+        if len(name) > max_length:
+            raise ValidationError(f'"{name}" is longer than {max_length} characters')
+        return name
+
+    def add_contacts(self, prepared):
+        # Runs in the chunk's transaction and returns the name -> id maps of the
+        # new contacts; they join the lookups only once the chunk is committed
+        created = {}
+        for (attribute, (model, field)), relation in zip(self.CONTACTS.items(), ('address', 'phone')):
+            lookup = getattr(self, attribute)
+            missing = {name for _, _, relations in prepared for name in relations.get(relation, ())
+                       if name_key(name) not in lookup}
+            new = {}
+            if missing:
+                model.objects.bulk_create([model(**{field: name}) for name in missing], ignore_conflicts=True)
+                new = self.load(model.objects.filter(**{f'{field}__in': missing}), field)
+            for _, _, relations in prepared:
+                if relation in relations:
+                    relations[relation] = list(dict.fromkeys(
+                        lookup.get(name_key(name)) or new[name_key(name)] for name in relations[relation]))
+            created[attribute] = new
+        return created
+
+
+class ImportReport():
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+        self.ids = set()
+        self.previous_keys = set()
+
+
+def cell_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, time):
+        return f'{value:%H:%M}'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def read_rows(file, filename):
+    # Yields (row number, {column: text}) one row at a time, file is opened in binary mode
+    if filename.lower().endswith('.xlsx'):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ImportError('openpyxl is required to import .xlsx files')
+        rows = load_workbook(file, read_only=True, data_only=True).active.iter_rows(values_only=True)
+        header = [cell_text(value) for value in next(rows, ())]
+        for number, values in enumerate(rows, 2):
+            if any(value is not None for value in values):
+                yield number, {column: cell_text(value) for column, value in zip(header, values) if column}
+    else:
+        reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig', newline=''))
+        for number, row in enumerate(reader, 2):
+            yield number, {column.strip(): (value or '').strip() for column, value in row.items() if column}
+
+
+def build(model, columns, row, lookups):
+    values = {}
+    relations = {}
+    errors = []
+    for column, (field, parse) in columns.items():
+        if column not in row:
+            continue
+        try:
+            value = parse(row[column], lookups) if row[column] else None
+        except ValidationError as e:
+            errors += [f'{column}: {message}' for message in e.messages]
+            continue
+        model_field = model._meta.get_field(field)
+        if model_field.many_to_many:
+            relations[field] = value or []
+        elif model_field.is_relation:
+            values[model_field.attname] = value
+        elif value is not None or model_field.null:
+            values[field] = value
+        # an empty cell of a required field keeps the model default
+
+    id = row.get('id')
+    if id:
+        try:
+            values['id'] = parse_int(id, lookups)
+        except ValidationError as e:
+            errors += [f'id: {message}' for message in e.messages]
+    if errors:
+        raise ValidationError(errors)
+
+    obj = model(**values)
+    # Relations were resolved from the lookups, validating them would query every row
+    exclude = [f.name for f in model._meta.fields if f.is_relation or f.attname not in values]
+    try:
+        obj.clean_fields(exclude=exclude)
+    except ValidationError as e:
+        raise ValidationError([f'{field}: {message}' for field, messages in e.message_dict.items()
+                               for message in messages])
+    return obj, relations
+
+
+def last_rows(prepared, field, report):
+    # A value that has to be unique is kept by the last row giving it, earlier rows are reported
+    last = {getattr(obj, field): number for number, obj, _ in prepared if getattr(obj, field)}
+    for number, obj, _ in prepared:
+        value = getattr(obj, field)
+        if value and last[value] != number:
+            report.errors.append((number, f'{field}: {value} is given again in row {last[value]}'))
+    return [item for item in prepared if not getattr(item[1], field) or last[getattr(item[1], field)] == item[0]]
+
+
+def import_chunk(kind, chunk, lookups, report):
+    model, columns, index_keys = KINDS[kind]
+    prepared = []
+    for number, row in chunk:
+        try:
+            obj, relations = build(model, columns, row, lookups)
+        except ValidationError as e:
+            report.errors.append((number, '; '.join(e.messages)))
+        else:
+            prepared.append((number, obj, relations))
+
+    existing = set(model.objects.filter(id__in=[obj.id for _, obj, _ in prepared if obj.id]).values_list('id', flat=True))
+    for number, obj, _ in prepared:
+        if obj.id and obj.id not in existing:
+            report.errors.append((number, f'id: no record with id {obj.id}'))
+    prepared = [item for item in prepared if not item[1].id or item[1].id in existing]
+    header = chunk[0][1]
+    prepared = last_rows(prepared, 'id', report)
+    if 'rating' in header:
+        prepared = last_rows(prepared, 'rating', report)
+    if not prepared:
+        return
+
+    update_fields = [field for column, (field, _) in columns.items()
+                     if column in header and not model._meta.get_field(field).many_to_many]
+    m2m_fields = [field for column, (field, _) in columns.items()
+                  if column in header and model._meta.get_field(field).many_to_many]
+    updates = [obj for _, obj, _ in prepared if obj.id]
+    creates = [obj for _, obj, _ in prepared if not obj.id]
+    if index_keys and updates:
+        report.previous_keys |= index_keys([obj.id for obj in updates])
+
+    try:
+        with transaction.atomic():
+            if kind == 'polyclinics':
+                created_contacts = lookups.add_contacts(prepared)
+            if 'rating' in header:
+                # A rating is held by one row, like in the admin the imported row takes it
+                for _, obj, _ in prepared:
+                    report.ids.update(ranking.take_rating(obj))
+            if updates:
+                # An UPDATE of the given columns only, an upsert would insert the
+                # model defaults first and fail on required columns missing from the file
+                now = timezone.now()
+                for obj in updates:
+                    obj.updated = now
+                model.objects.bulk_update(updates, update_fields + ['updated'])
+            if creates:
+                # update_conflicts does not return ids on Django 4.2, new rows get a plain insert
+                model.objects.bulk_create(creates)
+            for field in m2m_fields:
+                model_field = model._meta.get_field(field)
+                through = model_field.remote_field.through
+                source = f'{model_field.m2m_field_name()}_id'
+                target = f'{model_field.m2m_reverse_field_name()}_id'
+                through.objects.filter(**{f'{source}__in': [obj.id for obj in updates]}).delete()
+                through.objects.bulk_create([through(**{source: obj.id, target: target_id})
+                                             for _, obj, relations in prepared for target_id in relations[field]])
+    except IntegrityError as e:
+        # The whole chunk is rolled back, its rows are reported with the database error
+        message = str(e).splitlines()[0]
+        report.errors += [(number, f'not saved: {message}') for number, _, _ in prepared]
+        return
+    if kind == 'polyclinics':
+        for attribute, new in created_contacts.items():
+            getattr(lookups, attribute).update(new)
+
+    report.updated += len(updates)
+    report.created += len(creates)
+    report.ids.update(obj.id for _, obj, _ in prepared)
+
+
+def refresh(kind, report):
+    if not report.ids:
+        return
+    if kind == 'doctors':
+        index.rebuild(report.previous_keys | index.doctor_keys(report.ids))
+        search.update_vectors_on_commit(doctors_id=report.ids)
+        captions.invalidate(doctors_id=report.ids)
+    elif kind == 'polyclinics':
+        index.rebuild(report.previous_keys | index.polyclinic_keys(report.ids))
+        search.update_vectors_on_commit(polyclinics_id=report.ids)
+        captions.invalidate(polyclinics_id=report.ids)
+    elif kind == 'schedules':
+        captions.invalidate(doctors_id=Doctor.objects.filter(schedule__in=report.ids).values_list('id', flat=True))
+
+
+KINDS = {
+    'doctors': (Doctor, DOCTOR_COLUMNS, index.doctor_keys),
+    'polyclinics': (Polyclinic, POLYCLINIC_COLUMNS, index.polyclinic_keys),
+    'schedules': (Schedule, SCHEDULE_COLUMNS, None),
+}
+
+
+def import_file(kind, file, filename):
+    report = ImportReport()
+    lookups = Lookups()
+    rows = read_rows(file, filename)
+    try:
+        while chunk := list(islice(rows, settings.IMPORT_CHUNK_SIZE)):
+            import_chunk(kind, chunk, lookups, report)
+    finally:
+        # Chunks saved before a failure are already committed
+        refresh(kind, report)
+    logging.info(f'Import of {kind} from {filename}: {report.created} created, {report.updated} updated, '
+                 f'{len(report.errors)} rows with errors')
+    return report
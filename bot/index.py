@@ -0,0 +1,77 @@
+import logging
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+from bot.models import Doctor, Polyclinic
+
+
+# Rating-sorted result ids per (clinic_or_private, speciality, district), so the
+# webhook answers a district callback with one cache lookup instead of m2m joins.
+# Readers only add a missing key and never overwrite one: rebuild() runs after
+# commit, so a reader that queried before the commit must not replace its result.
+
+
+def index_key(clinic_or_private, speciality_id, district_id):
+    return f'search_index_{clinic_or_private}_{speciality_id}_{district_id}'
+
+
+def sort_by_rating(results):
+    results = sorted(results, key=lambda x: int(x['rating']) if x['rating'] else 10, reverse=True)
+    return [i['id'] for i in results]
+
+
+def build_results(clinic_or_private, speciality_id, district_id):
+    if clinic_or_private == 'private':
+        results = Doctor.objects.filter(district__id=district_id, speciality=speciality_id)
+    elif clinic_or_private == 'clinic':
+        results = Polyclinic.objects.filter(speciality__id=speciality_id, district=district_id)
+    else:
+        return []
+    return sort_by_rating(results.values('id', 'rating').order_by('id'))
+
+
+def get_results(clinic_or_private, speciality_id, district_id):
+    key = index_key(clinic_or_private, speciality_id, district_id)
+    results = cache.get(key)
+    if results is None:
+        results = build_results(clinic_or_private, speciality_id, district_id)
+        cache.add(key, results)
+    return results
+
+
+async def aget_results(clinic_or_private, speciality_id, district_id):
+    key = index_key(clinic_or_private, speciality_id, district_id)
+    results = await cache.aget(key)
+    if results is None:
+        results = await sync_to_async(build_results)(clinic_or_private, speciality_id, district_id)
+        await cache.aadd(key, results)
+    return results
+
+
+def doctor_keys(doctors_id):
+    rows = (Doctor.objects
+            .filter(id__in=doctors_id, speciality__isnull=False, district__isnull=False)
+            .values_list('speciality_id', 'district__id'))
+    return {('private', speciality_id, district_id) for speciality_id, district_id in rows}
+
+
+def polyclinic_keys(polyclinics_id):
+    rows = (Polyclinic.objects
+            .filter(id__in=polyclinics_id, speciality__isnull=False, district__isnull=False)
+            .values_list('speciality__id', 'district_id'))
+    return {('clinic', speciality_id, district_id) for speciality_id, district_id in rows}
+
+
+def rebuild(keys):
+    if keys:
+        cache.set_many({index_key(*key): build_results(*key) for key in keys})
+        logging.info(f'Search index rebuilt for {len(keys)} keys')
+
+
+def rebuild_on_commit(previous_keys=(), doctors_id=(), polyclinics_id=()):
+    # Keys for the new state are collected after commit, once every m2m change of
+    # an admin save has landed, so one save rebuilds each key with final data.
+    def callback():
+        keys = set(previous_keys) | doctor_keys(doctors_id) | polyclinic_keys(polyclinics_id)
+        rebuild(keys)
+    transaction.on_commit(callback)
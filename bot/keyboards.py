@@ -0,0 +1,54 @@
+import json
+from django.core.cache import cache
+from django.db.models import Q
+from bot.misc import batched
+from bot import callback
+from bot.models import Speciality, District
+
+
+SPECIALITIES_KEY = 'keyboard_specialities'
+DISTRICTS_KEY = 'keyboard_district_list'
+
+
+def build_specialities(speciality_id=None):
+    # speciality_id is a ranked list of search results, None stands for all specialities
+    where = Q() if speciality_id is None else Q(id__in=speciality_id)
+    specialities = Speciality.objects.filter(where).values('id', 'name').order_by('name')
+    if speciality_id is not None:
+        specialities = sorted(specialities, key=lambda x: speciality_id.index(x['id']))
+    buttons = [{'text': i['name'], 'callback_data': callback.encode('speciality', i['id'])} for i in specialities]
+    inline_keyboard = batched(buttons, 2)
+    return json.dumps({'inline_keyboard': inline_keyboard})
+
+
+def build_districts():
+    return list(District.objects.values_list('id', 'name').order_by('id'))
+
+
+# Readers only add a missing keyboard, rebuild() replaces them after commit, so
+# a keyboard built from rows read before the commit never overwrites it
+
+
+def specialities_reply_markup():
+    reply_markup = cache.get(SPECIALITIES_KEY)
+    if reply_markup is None:
+        reply_markup = build_specialities()
+        cache.add(SPECIALITIES_KEY, reply_markup)
+    return reply_markup
+
+
+def districts_reply_markup(clinic_or_private, speciality_id):
+    # Buttons carry the search they belong to, so only the district list is cached
+    districts = cache.get(DISTRICTS_KEY)
+    if districts is None:
+        districts = build_districts()
+        cache.add(DISTRICTS_KEY, districts)
+    choice = callback.CLINIC_OR_PRIVATE.index(clinic_or_private)
+    buttons = [{'text': name, 'callback_data': callback.encode('district', choice, speciality_id, id)}
+               for id, name in districts]
+    inline_keyboard = batched(buttons, 3)
+    return json.dumps({'inline_keyboard': inline_keyboard})
+
+
+def rebuild():
+    cache.set_many({SPECIALITIES_KEY: build_specialities(), DISTRICTS_KEY: build_districts()})
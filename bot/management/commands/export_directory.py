@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from bot import exporting
+
+
+class Command(BaseCommand):
+    help = 'Export doctors, polyclinics or schedules to CSV or JSON lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=exporting.EXPORTS)
+        parser.add_argument('--format', choices=exporting.FORMATS, default='csv')
+        parser.add_argument('--output', help='File to write, standard output by default')
+
+    def handle(self, kind, format, output, **options):
+        lines = exporting.export_lines(kind, format)
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as file:
+                file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from bot import importing
+
+
+class Command(BaseCommand):
+    help = 'Import doctors, polyclinics or schedules from a CSV or XLSX file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=importing.KINDS)
+        parser.add_argument('path')
+
+    def handle(self, kind, path, **options):
+        with open(path, 'rb') as file:
+            report = importing.import_file(kind, file, path)
+        for number, message in report.errors:
+            self.stderr.write(f'Row {number}: {message}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Created {report.created}, updated {report.updated}, rows with errors {len(report.errors)}'
+        ))
@@ -0,0 +1,87 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:44
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import Value
+
+
+BATCH_SIZE = 500
+
+
+def weighted_vector(*parts):
+    vector = None
+    for text, weight in parts:
+        part = SearchVector(Value(text), weight=weight, config=settings.DIRECTORY_SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+    return vector
+
+
+def save_vectors(model, objects, build):
+    batch = []
+    for obj in objects.iterator(chunk_size=BATCH_SIZE):
+        obj.search_vector = build(obj)
+        batch.append(obj)
+        if len(batch) == BATCH_SIZE:
+            model.objects.bulk_update(batch, ['search_vector'])
+            batch = []
+    if batch:
+        model.objects.bulk_update(batch, ['search_vector'])
+
+
+def doctor_vector(doctor):
+    polyclinics = doctor.polyclinic.all()
+    return weighted_vector(
+        (f'{doctor.last_name} {doctor.first_name} {doctor.paternal_name}', 'A'),
+        (doctor.speciality.name if doctor.speciality else '', 'B'),
+        (' '.join(polyclinic.name for polyclinic in polyclinics), 'C'),
+        (' '.join(address.name for polyclinic in polyclinics for address in polyclinic.address.all()), 'D'),
+    )
+
+
+def polyclinic_vector(polyclinic):
+    return weighted_vector(
+        (polyclinic.name, 'A'),
+        (' '.join(address.name for address in polyclinic.address.all()), 'B'),
+        (' '.join(speciality.name for speciality in polyclinic.speciality.all()), 'C'),
+    )
+
+
+def fill_search_vectors(apps, schema_editor):
+    # The vectors are built here from the historical models, as bot.search
+    # builds them at this point, so later changes to bot.search leave it alone
+    Doctor = apps.get_model('bot', 'Doctor')
+    Polyclinic = apps.get_model('bot', 'Polyclinic')
+    save_vectors(Doctor, Doctor.objects.select_related('speciality').prefetch_related('polyclinic__address'), doctor_vector)
+    save_vectors(Polyclinic, Polyclinic.objects.prefetch_related('address', 'speciality'), polyclinic_vector)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_rename_rating_general_doctor_rating_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doctor',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='polyclinic',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='doctor',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='bot_doctor_search__a15b43_gin'),
+        ),
+        migrations.AddIndex(
+            model_name='polyclinic',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='bot_polycli_search__8d3408_gin'),
+        ),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+    ]
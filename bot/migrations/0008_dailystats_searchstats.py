@@ -0,0 +1,55 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0007_user_last_seen'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='Date')),
+                ('users_total', models.IntegerField(default=0, verbose_name='Users')),
+                ('users_blocked', models.IntegerField(default=0, verbose_name='Blocked the bot')),
+                ('new_users', models.IntegerField(default=0, verbose_name='New users')),
+                ('active_users', models.IntegerField(default=0, verbose_name='Active users')),
+                ('searches', models.IntegerField(default=0, verbose_name='Searches')),
+                ('not_found', models.IntegerField(default=0, verbose_name='Not found')),
+                ('results', models.IntegerField(default=0, verbose_name='Results found')),
+                ('directory_searches', models.IntegerField(default=0, verbose_name='Directory searches')),
+                ('directory_not_found', models.IntegerField(default=0, verbose_name='Directory searches not found')),
+            ],
+            options={
+                'verbose_name': 'Daily statistics',
+                'verbose_name_plural': 'Daily statistics',
+            },
+        ),
+        migrations.CreateModel(
+            name='SearchStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Date')),
+                ('clinic_or_private', models.CharField(choices=[('clinic', 'Clinic'), ('private', 'Private doctor')], max_length=7, verbose_name='Clinic or private')),
+                ('searches', models.IntegerField(default=0, verbose_name='Searches')),
+                ('not_found', models.IntegerField(default=0, verbose_name='Not found')),
+                ('results', models.IntegerField(default=0, verbose_name='Results found')),
+                ('district', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bot.district', verbose_name='District')),
+                ('speciality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='bot.speciality', verbose_name='Speciality')),
+            ],
+            options={
+                'verbose_name': 'Search statistics',
+                'verbose_name_plural': 'Search statistics',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='searchstats',
+            constraint=models.UniqueConstraint(fields=('date', 'clinic_or_private', 'speciality', 'district'), name='unique_search_stats'),
+        ),
+    ]
@@ -1,7 +1,17 @@
+import os
+import json
+import time
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
-from bot.exception import ResponseException, TelegramException
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django_redis import get_redis_connection
+from celery._state import get_current_task
+from app.celery import BULK_QUEUE, BROADCAST_QUEUE
+from bot.exception import ResponseException, TelegramException, RetryAfterException, BlockedException
 from math import ceil
 
 
@@ -40,14 +50,133 @@ def batched(lst, num):
     return batch
 
 
-def send_message(method, **data):
-    url = f'https://api.telegram.org/bot{settings.TELEGRAM_TOKEN}/{method}'
-    if 'photo' in data:
-        file = data.pop('photo')
-        with open(file, 'rb') as f:
-            response = requests.post(url, data=data, files={'photo': f})
-    else:
-        response = requests.post(url, data=data)
+class TelegramClient():
+    def __init__(self, token, pool_size, connect_timeout, read_timeout, connect_retries):
+        self.base_url = f'https://api.telegram.org/bot{token}'
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=None, connect=connect_retries, read=0, redirect=0, status=0)
+        )
+        self.session.mount('https://', adapter)
+
+    def post(self, method, data, files=None):
+        if not files:
+            return self.session.post(f'{self.base_url}/{method}', data=data, timeout=self.timeout)
+        opened = {name: open(path, 'rb') for name, path in files.items()}
+        try:
+            return self.session.post(f'{self.base_url}/{method}', data=data, files=opened, timeout=self.timeout)
+        finally:
+            for f in opened.values():
+                f.close()
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    # Celery forks its pool after the module is imported, so every child process
+    # has to build its own session instead of sharing the parent's sockets.
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = TelegramClient(
+            settings.TELEGRAM_TOKEN,
+            pool_size=settings.TELEGRAM_POOL_SIZE,
+            connect_timeout=settings.TELEGRAM_CONNECT_TIMEOUT,
+            read_timeout=settings.TELEGRAM_READ_TIMEOUT,
+            connect_retries=settings.TELEGRAM_CONNECT_RETRIES,
+        )
+        _client_pid = os.getpid()
+    return _client
+
+
+class RateLimiter():
+    # Token buckets live in Redis so the limit holds across every sender replica.
+    # Both buckets are checked and charged in one script: a call either takes a
+    # token from each of them or from neither and returns how long to wait.
+    script = """
+        local now = redis.call('TIME')
+        now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+        local wait = 0
+        local buckets = {}
+        for i, key in ipairs(KEYS) do
+            local rate = tonumber(ARGV[i * 2 - 1])
+            local capacity = tonumber(ARGV[i * 2])
+            local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+            local tokens = tonumber(bucket[1]) or capacity
+            local ts = tonumber(bucket[2]) or now
+            tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+            if tokens < 1 then
+                wait = math.max(wait, (1 - tokens) / rate)
+            end
+            buckets[i] = {tokens, math.ceil(capacity / rate) + 1}
+        end
+        for i, key in ipairs(KEYS) do
+            local tokens = buckets[i][1]
+            if wait == 0 then
+                tokens = tokens - 1
+            end
+            redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+            redis.call('EXPIRE', key, buckets[i][2])
+        end
+        return tostring(wait)
+    """
+
+    def __init__(self):
+        self._script = None
+
+    def try_acquire(self, chat_id=None, bulk=False):
+        if self._script is None:
+            self._script = get_redis_connection('default').register_script(self.script)
+        keys = ['telegram_rate_global']
+        args = [settings.TELEGRAM_GLOBAL_RATE, settings.TELEGRAM_GLOBAL_BURST]
+        if chat_id:
+            keys.append(f'telegram_rate_chat_{chat_id}')
+            args += [settings.TELEGRAM_CHAT_RATE, settings.TELEGRAM_CHAT_BURST]
+        if bulk:
+            # Bulk sends get only part of the global rate, the rest stays free for interactive replies
+            keys.append('telegram_rate_bulk')
+            args += [settings.TELEGRAM_BULK_RATE, settings.TELEGRAM_BULK_BURST]
+        return float(self._script(keys=keys, args=args))
+
+    def acquire(self, chat_id=None, bulk=False):
+        while (wait := self.try_acquire(chat_id, bulk)) > 0:
+            time.sleep(wait)
+
+
+def is_bulk_task():
+    task = get_current_task()
+    if not task or not task.request:
+        return False
+    # Broadcasts have their own workers but share the bulk part of the rate
+    return (task.request.delivery_info or {}).get('routing_key') in (BULK_QUEUE, BROADCAST_QUEUE)
+
+
+rate_limiter = RateLimiter()
+
+# Only these put a message into the user's chat and count towards Telegram's
+# per-chat limit; for approveChatJoinRequest chat_id is the channel
+CHAT_METHODS = ('sendMessage', 'sendPhoto', 'sendMediaGroup')
+
+
+def send_message(method, files=None, **data):
+    chat_id = data.get('chat_id') if method in CHAT_METHODS else None
+    rate_limiter.acquire(chat_id, bulk=is_bulk_task())
+    response = get_client().post(method, data, files=files)
+    if response.status_code == 429:
+        retry_after = response.json().get('parameters', {}).get('retry_after', 1)
+        logging.warning(f'user_id={data.get("chat_id")} {method} is rate limited, retry after {retry_after}s')
+        raise RetryAfterException(f'user_id={data.get("chat_id")} status=429 {response.text}', retry_after)
+    if response.status_code == 403:
+        # The user blocked the bot or deleted the account, nothing will ever reach them
+        logging.warning(f'user_id={data.get("chat_id")} {method} is forbidden: {response.text}')
+        raise BlockedException(f'user_id={data.get("chat_id")} status=403 {response.text}')
     if response.status_code == 200:
         response_data = DotAccessibleDict(response.json())
         if response_data.ok:
@@ -58,3 +187,74 @@ def send_message(method, **data):
     else:
         logging.error(f'user_id={data.get("chat_id")} status={response.status_code} {response.text}')
         raise ResponseException(f'user_id={data.get("chat_id")} status={response.status_code} {response.text}')
+
+
+def delete_message(chat_id, message_id):
+    # A retried task may already have removed the message on its first run
+    try:
+        send_message('deleteMessage', chat_id=chat_id, message_id=message_id)
+    except RetryAfterException:
+        raise
+    except (TelegramException, ResponseException):
+        logging.warning(f'user_id={chat_id} message_id={message_id} could not be deleted')
+
+
+def file_id_cache_key(image_name):
+    return f'file_id_{image_name}'
+
+
+def send_photo(image_name, **data):
+    key = file_id_cache_key(image_name)
+    file_id = cache.get(key)
+    if file_id:
+        try:
+            return send_message('sendPhoto', photo=file_id, **data)
+        except (RetryAfterException, BlockedException):
+            raise
+        except (TelegramException, ResponseException):
+            logging.warning(f'Cached file_id for {image_name} was rejected, uploading again')
+            cache.delete(key)
+    result = send_message('sendPhoto', files={'photo': default_storage.path(image_name)}, **data)
+    cache.set(key, result.photo[-1]['file_id'])
+    return result
+
+
+def send_media_group(chat_id, items, **data):
+    # items is a list of (image_name, caption); Telegram accepts 2-10 per album
+    file_ids = cache.get_many([file_id_cache_key(image_name) for image_name, _ in items])
+    if file_ids:
+        try:
+            return _send_media_group(chat_id, items, file_ids, **data)
+        except (RetryAfterException, BlockedException):
+            raise
+        except (TelegramException, ResponseException):
+            logging.warning(f'Cached file_id rejected in media group for user_id={chat_id}, uploading again')
+            cache.delete_many(list(file_ids))
+    return _send_media_group(chat_id, items, {}, **data)
+
+
+def _send_media_group(chat_id, items, file_ids, **data):
+    media = []
+    files = {}
+    for image_name, caption in items:
+        key = file_id_cache_key(image_name)
+        if key in file_ids:
+            photo = file_ids[key]
+        else:
+            if image_name not in files:
+                files[image_name] = f'photo{len(files)}'
+            photo = f'attach://{files[image_name]}'
+        media.append({'type': 'photo', 'media': photo, 'caption': caption, 'parse_mode': 'HTML'})
+    result = send_message(
+        'sendMediaGroup',
+        files={attach: default_storage.path(image_name) for image_name, attach in files.items()},
+        chat_id=chat_id,
+        media=json.dumps(media),
+        **data
+    )
+    uploaded = {}
+    for (image_name, _), message in zip(items, result):
+        if image_name in files:
+            uploaded[file_id_cache_key(image_name)] = message['photo'][-1]['file_id']
+    cache.set_many(uploaded)
+    return result
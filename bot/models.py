@@ -2,6 +2,8 @@ from django.db import models
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from bot import texts
 from django.contrib import admin
 
@@ -35,6 +37,7 @@ class User(BaseModel):
     phone = models.CharField(_('Phone number'), max_length=15, blank=True, null=True)
     is_bot = models.BooleanField(_('Is bot'), default=False)
     is_deleted = models.BooleanField(_('Is deleted'), default=False)
+    last_seen = models.DateTimeField(_('Last seen'), blank=True, null=True)
 
     def __str__(self):
         return f'{self.id} {self.username}'
@@ -130,7 +133,8 @@ class Schedule(BaseModel):
 class Polyclinic(BaseModel):
     class Meta:
         indexes = [
-            models.Index(fields=['district'])
+            models.Index(fields=['district']),
+            GinIndex(fields=['search_vector']),
         ]
         verbose_name_plural = _('Polyclinics')
         verbose_name = _('Polyclinic')
@@ -145,6 +149,7 @@ class Polyclinic(BaseModel):
     work_time_end = models.TimeField(_('Work time end'), blank=True, null=True)
     district = models.ForeignKey('District', on_delete=models.SET_NULL, related_name='polyclinic', verbose_name=_('District'), blank=True, null=True)
     rating = models.CharField(_('Rating'), choices=RATING, blank=True, null=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     @admin.display(description=_('Work time'))
     def work_time(self):
@@ -154,8 +159,10 @@ class Polyclinic(BaseModel):
             return f'{self.work_time_start:%H:%M} - {self.work_time_end:%H:%M}'
 
     def __str__(self):
-        if self.address.exists():
-            return f'{self.name} - {self.address.all()[0]}'
+        # Served from prefetch_related('address') when the caller preloaded it
+        address = self.address.all()[:1]
+        if address:
+            return f'{self.name} - {address[0]}'
         else:
             return self.name
 
@@ -163,7 +170,8 @@ class Polyclinic(BaseModel):
 class Doctor(BaseModel):
     class Meta:
         indexes = [
-            models.Index(fields=['speciality'])
+            models.Index(fields=['speciality']),
+            GinIndex(fields=['search_vector']),
         ]
         verbose_name_plural = _('Doctors')
         verbose_name = _('Doctor')
@@ -181,6 +189,7 @@ class Doctor(BaseModel):
     cost = models.FloatField(_('Cost'), default=0, validators=[MinValueValidator(0), MaxValueValidator(100000)])
     schedule = models.ManyToManyField(Schedule, verbose_name=_('Schedule'))
     rating = models.CharField(_('Rating'), choices=RATING, blank=True, null=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     @property
     def full_name(self):
@@ -205,3 +214,49 @@ class Share(BaseModel):
 
     def __str__(self):
         return f'{self.name} {self.start_date:%d.%m.%Y}-{self.end_date:%d.%m.%Y}, {self.sum}'
+
+
+class DailyStats(models.Model):
+    class Meta:
+        verbose_name_plural = _('Daily statistics')
+        verbose_name = _('Daily statistics')
+
+    date = models.DateField(_('Date'), unique=True)
+    users_total = models.IntegerField(_('Users'), default=0)
+    users_blocked = models.IntegerField(_('Blocked the bot'), default=0)
+    new_users = models.IntegerField(_('New users'), default=0)
+    active_users = models.IntegerField(_('Active users'), default=0)
+    searches = models.IntegerField(_('Searches'), default=0)
+    not_found = models.IntegerField(_('Not found'), default=0)
+    results = models.IntegerField(_('Results found'), default=0)
+    directory_searches = models.IntegerField(_('Directory searches'), default=0)
+    directory_not_found = models.IntegerField(_('Directory searches not found'), default=0)
+
+    def __str__(self):
+        return f'{self.date:%d.%m.%Y}'
+
+
+class SearchStats(models.Model):
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'clinic_or_private', 'speciality', 'district'],
+                                    name='unique_search_stats'),
+        ]
+        verbose_name_plural = _('Search statistics')
+        verbose_name = _('Search statistics')
+
+    CLINIC_OR_PRIVATE = (
+        ('clinic', _('Clinic')),
+        ('private', _('Private doctor')),
+    )
+
+    date = models.DateField(_('Date'))
+    clinic_or_private = models.CharField(_('Clinic or private'), max_length=7, choices=CLINIC_OR_PRIVATE)
+    speciality = models.ForeignKey(Speciality, on_delete=models.CASCADE, verbose_name=_('Speciality'))
+    district = models.ForeignKey(District, on_delete=models.CASCADE, verbose_name=_('District'))
+    searches = models.IntegerField(_('Searches'), default=0)
+    not_found = models.IntegerField(_('Not found'), default=0)
+    results = models.IntegerField(_('Results found'), default=0)
+
+    def __str__(self):
+        return f'{self.date:%d.%m.%Y} {self.speciality} {self.district}'
@@ -0,0 +1,29 @@
+import zlib
+from django.db import connection, transaction
+
+
+def rating_lock(model, rating):
+    # Row locks only cover rows that already hold the rating, two saves giving
+    # it to different rows would both find nothing to lock and both keep it.
+    # The advisory lock is taken per (table, rating) and held until the
+    # caller's transaction commits.
+    table = zlib.crc32(model._meta.db_table.encode()) - 2 ** 31
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [table, int(rating)])
+
+
+def take_rating(obj):
+    # A rating is a slot held by one row at a time. Giving it to obj takes it
+    # from the current holders with one UPDATE, later saves of the same rating
+    # wait for the admin transaction to commit. Returns the holders' ids for
+    # cache invalidation.
+    if not obj.rating:
+        return []
+    model = type(obj)
+    with transaction.atomic():
+        rating_lock(model, obj.rating)
+        holders = model.objects.filter(rating=obj.rating).exclude(pk=obj.pk)
+        holders_id = list(holders.values_list('id', flat=True))
+        if holders_id:
+            model.objects.filter(id__in=holders_id).update(rating=None)
+    return holders_id
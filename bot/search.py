@@ -0,0 +1,193 @@
+import re
+import logging
+from collections import Counter
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
+from django.db.models import F, Value
+from bot.models import Speciality, Doctor, Polyclinic
+
+
+SPECIALITY_INDEX_VERSION_KEY = 'speciality_index_version'
+VECTOR_BATCH_SIZE = 500
+
+
+def normalize(text):
+    text = text.lower().replace('ё', 'е')
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+
+def trigrams(text):
+    # Words are padded like pg_trgm does, so the beginning of a word weighs more
+    # and a short prefix such as "кард" still finds "кардиолог"
+    grams = set()
+    for word in text.split():
+        word = f'  {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+class SpecialityIndex():
+    # Trigram index over speciality names, one per worker process. Every search
+    # compares its version with the one in the cache, which the Speciality
+    # signals bump, and builds a new index when they differ. An index is never
+    # changed once built: the new one replaces the module-level reference in
+    # one assignment, so a search running meanwhile keeps a consistent index.
+
+    def __init__(self, version=None, names=None, sizes=None, postings=None):
+        self.version = version
+        self.names = names or {}
+        self.sizes = sizes or {}
+        self.postings = postings or {}
+
+    @classmethod
+    def build(cls, version):
+        names = {}
+        sizes = {}
+        postings = {}
+        for id, name in Speciality.objects.values_list('id', 'name'):
+            names[id] = normalize(name)
+            grams = trigrams(names[id])
+            sizes[id] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, set()).add(id)
+        logging.info(f'Speciality search index rebuilt: {len(names)} specialities, version {version}')
+        return cls(version, names, sizes, postings)
+
+    def search(self, text):
+        text = normalize(text)
+        query = trigrams(text)
+        if not query:
+            return []
+        common = Counter()
+        for gram in query:
+            for id in self.postings.get(gram, ()):
+                common[id] += 1
+        scores = {}
+        for id, name in self.names.items():
+            found = common.get(id, 0)
+            coverage = found / len(query)
+            similarity = found / (len(query) + self.sizes[id] - found)
+            if text in name:
+                scores[id] = 2 + similarity
+            elif coverage >= settings.SPECIALITY_SEARCH_THRESHOLD:
+                scores[id] = coverage + similarity
+        ranked = sorted(scores, key=lambda id: (-scores[id], self.names[id]))
+        return ranked[:settings.SPECIALITY_SEARCH_LIMIT]
+
+
+speciality_index = SpecialityIndex()
+
+
+def bump_speciality_index_version():
+    cache.add(SPECIALITY_INDEX_VERSION_KEY, 0, timeout=None)
+    cache.incr(SPECIALITY_INDEX_VERSION_KEY)
+
+
+async def asearch_specialities(text):
+    global speciality_index
+    version = await cache.aget(SPECIALITY_INDEX_VERSION_KEY, 0)
+    current = speciality_index
+    if current.version != version:
+        current = await sync_to_async(SpecialityIndex.build)(version)
+        speciality_index = current
+    return current.search(text)
+
+
+# Full-text search over doctors and polyclinics. The vectors join names from
+# related tables, so they are stored on the rows and refreshed from signals
+# rather than computed per query.
+
+
+def weighted_vector(*parts):
+    # parts are (text, weight) pairs, the most specific text goes first with weight A
+    vector = None
+    for text, weight in parts:
+        part = SearchVector(Value(text), weight=weight, config=settings.DIRECTORY_SEARCH_CONFIG)
+        vector = part if vector is None else vector + part
+    return vector
+
+
+def save_vectors(model, objects, build):
+    batch = []
+    for obj in objects.iterator(chunk_size=VECTOR_BATCH_SIZE):
+        obj.search_vector = build(obj)
+        batch.append(obj)
+        if len(batch) == VECTOR_BATCH_SIZE:
+            model.objects.bulk_update(batch, ['search_vector'])
+            batch = []
+    if batch:
+        model.objects.bulk_update(batch, ['search_vector'])
+
+
+def doctor_vector(doctor):
+    polyclinics = doctor.polyclinic.all()
+    return weighted_vector(
+        (f'{doctor.last_name} {doctor.first_name} {doctor.paternal_name}', 'A'),
+        (doctor.speciality.name if doctor.speciality else '', 'B'),
+        (' '.join(polyclinic.name for polyclinic in polyclinics), 'C'),
+        (' '.join(address.name for polyclinic in polyclinics for address in polyclinic.address.all()), 'D'),
+    )
+
+
+def polyclinic_vector(polyclinic):
+    return weighted_vector(
+        (polyclinic.name, 'A'),
+        (' '.join(address.name for address in polyclinic.address.all()), 'B'),
+        (' '.join(speciality.name for speciality in polyclinic.speciality.all()), 'C'),
+    )
+
+
+def update_doctor_vectors(doctors_id=None):
+    doctors = Doctor.objects.select_related('speciality').prefetch_related('polyclinic__address')
+    if doctors_id is not None:
+        doctors = doctors.filter(id__in=doctors_id)
+    save_vectors(Doctor, doctors, doctor_vector)
+
+
+def update_polyclinic_vectors(polyclinics_id=None):
+    polyclinics = Polyclinic.objects.prefetch_related('address', 'speciality')
+    if polyclinics_id is not None:
+        polyclinics = polyclinics.filter(id__in=polyclinics_id)
+    save_vectors(Polyclinic, polyclinics, polyclinic_vector)
+
+
+def update_vectors_on_commit(doctors_id=(), polyclinics_id=()):
+    # Doctor vectors include their polyclinics' names and addresses
+    doctors_id = set(doctors_id)
+    polyclinics_id = set(polyclinics_id)
+    if polyclinics_id:
+        doctors_id |= set(Doctor.objects.filter(polyclinic__in=polyclinics_id).values_list('id', flat=True))
+
+    def callback():
+        if doctors_id:
+            update_doctor_vectors(doctors_id)
+        if polyclinics_id:
+            update_polyclinic_vectors(polyclinics_id)
+    transaction.on_commit(callback)
+
+
+def directory_query(text):
+    # Every word is matched as a prefix, so a partly typed surname still finds the doctor
+    words = normalize(text).split()
+    if not words:
+        return None
+    return SearchQuery(' & '.join(f'{word}:*' for word in words),
+                       search_type='raw', config=settings.DIRECTORY_SEARCH_CONFIG)
+
+
+async def asearch_directory(text):
+    query = directory_query(text)
+    if query is None:
+        return [], []
+    results = []
+    for model in (Doctor, Polyclinic):
+        queryset = (model.objects
+                    .filter(search_vector=query)
+                    .annotate(rank=SearchRank(F('search_vector'), query))
+                    .order_by('-rank', 'id')
+                    .values_list('id', flat=True)[:settings.DIRECTORY_SEARCH_LIMIT])
+        results.append([i async for i in queryset])
+    return results
@@ -0,0 +1,217 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+from bot.models import Doctor, Polyclinic, Share, Speciality, District, Position, Schedule, Address, Phone
+from bot.misc import file_id_cache_key
+from bot import index, keyboards, captions, search
+
+
+@receiver(pre_save, sender=Doctor)
+@receiver(pre_save, sender=Polyclinic)
+@receiver(pre_save, sender=Share)
+def drop_replaced_image_file_id(sender, instance, **kwargs):
+    if not instance.pk:
+        return
+    previous_image = sender.objects.filter(pk=instance.pk).values_list('image', flat=True).first()
+    if previous_image and previous_image != instance.image.name:
+        cache.delete(file_id_cache_key(previous_image))
+
+
+@receiver(pre_save, sender=Doctor)
+@receiver(pre_delete, sender=Doctor)
+def remember_doctor_index_keys(sender, instance, **kwargs):
+    instance._index_keys = index.doctor_keys([instance.pk]) if instance.pk else set()
+
+
+@receiver(pre_save, sender=Polyclinic)
+@receiver(pre_delete, sender=Polyclinic)
+def remember_polyclinic_index_keys(sender, instance, **kwargs):
+    instance._index_keys = index.polyclinic_keys([instance.pk]) if instance.pk else set()
+
+
+@receiver(post_save, sender=Doctor)
+def reindex_saved_doctor(sender, instance, **kwargs):
+    index.rebuild_on_commit(getattr(instance, '_index_keys', ()), doctors_id=[instance.pk])
+
+
+@receiver(post_save, sender=Polyclinic)
+def reindex_saved_polyclinic(sender, instance, **kwargs):
+    index.rebuild_on_commit(getattr(instance, '_index_keys', ()), polyclinics_id=[instance.pk])
+
+
+@receiver(post_delete, sender=Doctor)
+@receiver(post_delete, sender=Polyclinic)
+def reindex_deleted(sender, instance, **kwargs):
+    index.rebuild_on_commit(getattr(instance, '_index_keys', ()))
+
+
+@receiver(m2m_changed, sender=Doctor.district.through)
+def reindex_doctor_districts(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if not reverse:
+            doctors_id = [instance.pk]
+        elif action == 'pre_clear':
+            doctors_id = list(instance.doctor_set.values_list('id', flat=True))
+        else:
+            doctors_id = list(pk_set)
+        instance._index_doctors_id = doctors_id
+        instance._index_keys = index.doctor_keys(doctors_id)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        index.rebuild_on_commit(instance._index_keys, doctors_id=instance._index_doctors_id)
+
+
+@receiver(m2m_changed, sender=Polyclinic.speciality.through)
+def reindex_polyclinic_specialities(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if not reverse:
+            polyclinics_id = [instance.pk]
+        elif action == 'pre_clear':
+            polyclinics_id = list(instance.polyclinic_set.values_list('id', flat=True))
+        else:
+            polyclinics_id = list(pk_set)
+        instance._index_polyclinics_id = polyclinics_id
+        instance._index_keys = index.polyclinic_keys(polyclinics_id)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        index.rebuild_on_commit(instance._index_keys, polyclinics_id=instance._index_polyclinics_id)
+
+
+@receiver(pre_delete, sender=Speciality)
+def remember_speciality_index_keys(sender, instance, **kwargs):
+    doctors_id = instance.doctor.values_list('id', flat=True)
+    polyclinics_id = instance.polyclinic_set.values_list('id', flat=True)
+    instance._index_keys = index.doctor_keys(doctors_id) | index.polyclinic_keys(polyclinics_id)
+
+
+@receiver(pre_delete, sender=District)
+def remember_district_index_keys(sender, instance, **kwargs):
+    doctors_id = instance.doctor_set.values_list('id', flat=True)
+    polyclinics_id = instance.polyclinic.values_list('id', flat=True)
+    instance._index_keys = index.doctor_keys(doctors_id) | index.polyclinic_keys(polyclinics_id)
+
+
+@receiver(post_delete, sender=Speciality)
+@receiver(post_delete, sender=District)
+def reindex_deleted_reference(sender, instance, **kwargs):
+    index.rebuild_on_commit(instance._index_keys)
+
+
+@receiver(post_save, sender=Speciality)
+@receiver(post_delete, sender=Speciality)
+@receiver(post_save, sender=District)
+@receiver(post_delete, sender=District)
+def rebuild_keyboards(sender, **kwargs):
+    transaction.on_commit(keyboards.rebuild)
+
+
+@receiver(post_save, sender=Speciality)
+@receiver(post_delete, sender=Speciality)
+def rebuild_speciality_search_index(sender, **kwargs):
+    transaction.on_commit(search.bump_speciality_index_version)
+
+
+def m2m_changed_ids(instance, action, reverse, pk_set, reverse_accessor):
+    if not reverse:
+        return [instance.pk]
+    if action == 'pre_clear':
+        return list(getattr(instance, reverse_accessor).values_list('id', flat=True))
+    return list(pk_set or ())
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(pre_delete, sender=Doctor)
+def invalidate_doctor_caption(sender, instance, **kwargs):
+    captions.invalidate(doctors_id=[instance.pk])
+
+
+@receiver(post_save, sender=Polyclinic)
+@receiver(pre_delete, sender=Polyclinic)
+def invalidate_polyclinic_caption(sender, instance, **kwargs):
+    captions.invalidate(polyclinics_id=[instance.pk])
+
+
+@receiver(post_save, sender=Share)
+@receiver(pre_delete, sender=Share)
+def invalidate_share_caption(sender, instance, **kwargs):
+    captions.invalidate(shares_id=[instance.pk])
+
+
+@receiver(post_save, sender=Schedule)
+@receiver(pre_delete, sender=Schedule)
+def invalidate_schedule_captions(sender, instance, **kwargs):
+    captions.invalidate(doctors_id=instance.doctor_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Speciality)
+@receiver(pre_delete, sender=Speciality)
+@receiver(post_save, sender=Position)
+@receiver(pre_delete, sender=Position)
+def invalidate_reference_captions(sender, instance, **kwargs):
+    doctors_id = Doctor.objects.filter(**{sender._meta.model_name: instance}).values_list('id', flat=True)
+    captions.invalidate(doctors_id=doctors_id)
+
+
+@receiver(post_save, sender=Address)
+@receiver(pre_delete, sender=Address)
+@receiver(post_save, sender=Phone)
+@receiver(pre_delete, sender=Phone)
+def invalidate_contact_captions(sender, instance, **kwargs):
+    captions.invalidate(polyclinics_id=instance.polyclinic_set.values_list('id', flat=True))
+
+
+@receiver(m2m_changed, sender=Doctor.polyclinic.through)
+@receiver(m2m_changed, sender=Doctor.schedule.through)
+def invalidate_doctor_relation_captions(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        captions.invalidate(doctors_id=m2m_changed_ids(instance, action, reverse, pk_set, 'doctor_set'))
+
+
+@receiver(m2m_changed, sender=Polyclinic.address.through)
+@receiver(m2m_changed, sender=Polyclinic.phone.through)
+def invalidate_polyclinic_relation_captions(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        captions.invalidate(polyclinics_id=m2m_changed_ids(instance, action, reverse, pk_set, 'polyclinic_set'))
+
+
+@receiver(post_save, sender=Doctor)
+def update_doctor_search_vector(sender, instance, **kwargs):
+    search.update_vectors_on_commit(doctors_id=[instance.pk])
+
+
+@receiver(post_save, sender=Polyclinic)
+def update_polyclinic_search_vector(sender, instance, **kwargs):
+    search.update_vectors_on_commit(polyclinics_id=[instance.pk])
+
+
+@receiver(pre_delete, sender=Polyclinic)
+def update_deleted_polyclinic_search_vectors(sender, instance, **kwargs):
+    search.update_vectors_on_commit(doctors_id=instance.doctor_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Address)
+@receiver(pre_delete, sender=Address)
+def update_address_search_vectors(sender, instance, **kwargs):
+    search.update_vectors_on_commit(polyclinics_id=instance.polyclinic_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Speciality)
+@receiver(pre_delete, sender=Speciality)
+def update_speciality_search_vectors(sender, instance, **kwargs):
+    search.update_vectors_on_commit(
+        doctors_id=instance.doctor.values_list('id', flat=True),
+        polyclinics_id=instance.polyclinic_set.values_list('id', flat=True),
+    )
+
+
+@receiver(m2m_changed, sender=Doctor.polyclinic.through)
+def update_doctor_polyclinics_search_vectors(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        search.update_vectors_on_commit(doctors_id=m2m_changed_ids(instance, action, reverse, pk_set, 'doctor_set'))
+
+
+@receiver(m2m_changed, sender=Polyclinic.address.through)
+@receiver(m2m_changed, sender=Polyclinic.speciality.through)
+def update_polyclinic_relations_search_vectors(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        polyclinics_id = m2m_changed_ids(instance, action, reverse, pk_set, 'polyclinic_set')
+        search.update_vectors_on_commit(polyclinics_id=polyclinics_id)
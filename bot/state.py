@@ -0,0 +1,48 @@
+import asyncio
+from weakref import WeakKeyDictionary
+from redis import Redis, asyncio as aioredis
+from django.conf import settings
+
+
+# Per-user conversation state, one Redis hash per user with a sliding TTL:
+#   search             'speciality' or 'directory' while a free-text search is expected
+# The choices of a search by speciality are not kept here, every callback
+# button carries them itself (see bot.callback).
+
+_clients = WeakKeyDictionary()
+_sync_client = None
+
+
+def get_client():
+    # redis.asyncio connections are bound to the event loop that opened them
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = aioredis.Redis.from_url(settings.CONVERSATION_REDIS_URL, decode_responses=True)
+    return _clients[loop]
+
+
+def get_sync_client():
+    # Celery tasks have no event loop and use a plain client on the same database
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = Redis.from_url(settings.CONVERSATION_REDIS_URL, decode_responses=True)
+    return _sync_client
+
+
+def state_key(user_id):
+    return f'conversation_{user_id}'
+
+
+async def aget_state(user_id):
+    return await get_client().hgetall(state_key(user_id))
+
+
+async def aupdate_state(user_id, clear=(), **fields):
+    key = state_key(user_id)
+    async with get_client().pipeline(transaction=True) as pipe:
+        if clear:
+            pipe.hdel(key, *clear)
+        if fields:
+            pipe.hset(key, mapping=fields)
+        pipe.expire(key, settings.CONVERSATION_STATE_TTL)
+        await pipe.execute()
@@ -0,0 +1,138 @@
+import logging
+from django.conf import settings
+from django.utils import timezone
+from bot.models import DailyStats, SearchStats, Speciality, District
+from bot import state
+
+
+# Usage counters are incremented in Redis as updates come in, per day:
+#   stats_<date>          daily totals, plus the users gauges copied from stats_users
+#   stats_<date>_search   '<clinic_or_private>:<speciality>:<district>:<counter>' fields
+#   stats_<date>_active   HyperLogLog of users seen that day
+# rollup() copies the whole day into the stats tables. Counters are never
+# reset by it, so running it again just writes the same or newer totals.
+# stats_users keeps the running users_total and users_blocked, changed by the
+# activity flush and by broadcasts; get_users_count seeds it and rarely
+# reconciles it with the users table.
+
+DAILY_COUNTERS = ('new_users', 'searches', 'not_found', 'results', 'directory_searches', 'directory_not_found')
+DAILY_GAUGES = ('users_total', 'users_blocked')
+USERS_KEY = 'stats_users'
+SEARCH_COUNTERS = ('searches', 'not_found', 'results')
+
+
+def stats_key(day, name=''):
+    return f'stats_{day:%Y-%m-%d}{name}'
+
+
+def search_field(clinic_or_private, speciality_id, district_id, counter):
+    return f'{clinic_or_private}:{speciality_id}:{district_id}:{counter}'
+
+
+async def arecord_search(clinic_or_private, speciality_id, district_id, results):
+    day = timezone.localdate()
+    daily = stats_key(day)
+    search = stats_key(day, '_search')
+    async with state.get_client().pipeline(transaction=False) as pipe:
+        pipe.hincrby(daily, 'searches', 1)
+        pipe.hincrby(daily, 'results', results)
+        pipe.hincrby(search, search_field(clinic_or_private, speciality_id, district_id, 'searches'), 1)
+        pipe.hincrby(search, search_field(clinic_or_private, speciality_id, district_id, 'results'), results)
+        if not results:
+            pipe.hincrby(daily, 'not_found', 1)
+            pipe.hincrby(search, search_field(clinic_or_private, speciality_id, district_id, 'not_found'), 1)
+        pipe.expire(daily, settings.STATS_TTL)
+        pipe.expire(search, settings.STATS_TTL)
+        await pipe.execute()
+
+
+async def arecord_directory_search(results):
+    daily = stats_key(timezone.localdate())
+    async with state.get_client().pipeline(transaction=False) as pipe:
+        pipe.hincrby(daily, 'directory_searches', 1)
+        if not results:
+            pipe.hincrby(daily, 'directory_not_found', 1)
+        pipe.expire(daily, settings.STATS_TTL)
+        await pipe.execute()
+
+
+def active_users_commands(pipe, user_id):
+    active = stats_key(timezone.localdate(), '_active')
+    pipe.pfadd(active, user_id)
+    pipe.expire(active, settings.STATS_TTL)
+
+
+def record_users(new=0, blocked=0):
+    # blocked is the change in users who blocked the bot, negative when they come back
+    daily = stats_key(timezone.localdate())
+    with state.get_sync_client().pipeline(transaction=False) as pipe:
+        if new:
+            pipe.hincrby(daily, 'new_users', new)
+            pipe.expire(daily, settings.STATS_TTL)
+            pipe.hincrby(USERS_KEY, 'users_total', new)
+        if blocked:
+            pipe.hincrby(USERS_KEY, 'users_blocked', blocked)
+        pipe.execute()
+
+
+def set_users_count(total, blocked):
+    state.get_sync_client().hset(USERS_KEY, mapping={'users_total': total, 'users_blocked': blocked, 'seeded': 1})
+
+
+def users_seeded():
+    return bool(state.get_sync_client().hexists(USERS_KEY, 'seeded'))
+
+
+def copy_users_count(day):
+    client = state.get_sync_client()
+    users = client.hmget(USERS_KEY, DAILY_GAUGES)
+    daily = stats_key(day)
+    with client.pipeline(transaction=False) as pipe:
+        pipe.hset(daily, mapping={name: int(value or 0) for name, value in zip(DAILY_GAUGES, users)})
+        pipe.expire(daily, settings.STATS_TTL)
+        pipe.execute()
+
+
+def rollup(day):
+    client = state.get_sync_client()
+    with client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(stats_key(day))
+        pipe.hgetall(stats_key(day, '_search'))
+        pipe.pfcount(stats_key(day, '_active'))
+        daily, search, active_users = pipe.execute()
+    if not (daily or search or active_users):
+        return
+
+    fields = DAILY_COUNTERS + DAILY_GAUGES
+    DailyStats.objects.bulk_create(
+        [DailyStats(date=day, active_users=active_users, **{name: int(daily.get(name, 0)) for name in fields})],
+        update_conflicts=True, unique_fields=['date'], update_fields=fields + ('active_users',)
+    )
+
+    rows = {}
+    for field, value in search.items():
+        clinic_or_private, speciality_id, district_id, counter = field.split(':')
+        rows.setdefault((clinic_or_private, int(speciality_id), int(district_id)), {})[counter] = int(value)
+    # Rows of a speciality or district deleted since the search are dropped
+    specialities = set(Speciality.objects.filter(id__in={key[1] for key in rows}).values_list('id', flat=True))
+    districts = set(District.objects.filter(id__in={key[2] for key in rows}).values_list('id', flat=True))
+    search_stats = [
+        SearchStats(date=day, clinic_or_private=clinic_or_private, speciality_id=speciality_id,
+                    district_id=district_id, **{name: counters.get(name, 0) for name in SEARCH_COUNTERS})
+        for (clinic_or_private, speciality_id, district_id), counters in rows.items()
+        if speciality_id in specialities and district_id in districts
+    ]
+    SearchStats.objects.bulk_create(
+        search_stats, update_conflicts=True,
+        unique_fields=['date', 'clinic_or_private', 'speciality', 'district'], update_fields=SEARCH_COUNTERS
+    )
+    logging.info(f'Stats for {day} rolled up: {len(search_stats)} search rows')
+
+
+def rollup_recent():
+    # Yesterday is rolled up as well, to pick up what was counted just before midnight
+    # The users gauges of a day are the running counters at its last rollup
+    today = timezone.localdate()
+    rollup(today - timezone.timedelta(days=1))
+    copy_users_count(today)
+    rollup(today)
@@ -1,25 +1,76 @@
+import time
 import logging
 import json
 from celery.utils.log import get_task_logger
-from django.db.models.functions import Concat, Cast
-from django.db.models import CharField, Value, F, Q
+from requests import RequestException
+from django.db import connection, OperationalError, InterfaceError
+from django.db.models import Count, Q
+from django.conf import settings
 from app.celery import app
-from bot.misc import send_message, batched
-from bot import texts
-from bot.models import Speciality, District, Doctor, Polyclinic, Share
+from bot.misc import send_message, send_photo, send_media_group, delete_message, batched
+from bot.exception import RetryAfterException, BlockedException, TelegramException, ResponseException
+from bot.models import User
+from bot import texts, keyboards, captions, callback, broadcast, activity, stats
 
 
 logger = get_task_logger(__name__)
 logger.setLevel(logging.INFO)
 
 
-@app.task()
+class TelegramTask(app.Task):
+    max_retries = settings.TELEGRAM_MAX_RETRIES
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return super().__call__(*args, **kwargs)
+        except RetryAfterException as e:
+            logger.warning(f'{self.name} hit the Telegram rate limit, retrying in {e.retry_after}s')
+            raise self.retry(exc=e, countdown=e.retry_after)
+        except (OperationalError, InterfaceError) as e:
+            # The server side of a reused connection went away, reconnect on the next attempt
+            logger.warning(f'{self.name} lost the database connection, retrying: {e}')
+            connection.close()
+            raise self.retry(exc=e, countdown=1)
+
+
+def with_retry_after(function, *args, **kwargs):
+    # Retrying the task would send again every card delivered before the 429,
+    # so only the rejected call is repeated, after the wait Telegram asked for
+    for _ in range(settings.TELEGRAM_MAX_RETRIES):
+        try:
+            return function(*args, **kwargs)
+        except RetryAfterException as e:
+            logger.warning(f'Rate limited by Telegram, sending again in {e.retry_after}s')
+            time.sleep(e.retry_after)
+    return function(*args, **kwargs)
+
+
+def send_cards(id, cards):
+    if settings.TELEGRAM_ALBUM_MODE and len(cards) > 1:
+        for album in batched(cards, 10):
+            if len(album) == 1:
+                with_retry_after(send_photo, album[0][0], chat_id=id, parse_mode='HTML', caption=album[0][1])
+            else:
+                with_retry_after(send_media_group, id, album)
+    else:
+        for image_name, caption in cards:
+            with_retry_after(send_photo, image_name, chat_id=id, parse_mode='HTML', caption=caption)
+
+
+def send_more_button(id, more_callback_data, remaining):
+    inline_keyboard = [[{'text': f'{texts.more} ({remaining})', 'callback_data': more_callback_data}]]
+    reply_markup = json.dumps({'inline_keyboard': inline_keyboard})
+    with_retry_after(send_message, 'sendMessage', chat_id=id, parse_mode='HTML',
+                     text=f'<i>{texts.more_message}</i>', reply_markup=reply_markup)
+
+
+@app.task(base=TelegramTask)
 def send_message_approve(user_id, chat_id):
     send_message('approveChatJoinRequest', user_id=user_id, chat_id=chat_id)
     logger.info(f'Send message approve to {user_id=} successfully')
 
 
-@app.task()
+@app.task(base=TelegramTask)
 def send_message_to_new_user(id):
     text = f'{texts.start}'
     reply_markup = json.dumps(
@@ -28,6 +79,8 @@ def send_message_to_new_user(id):
                 {'text': texts.my_doctor_button},
                 {'text': texts.search_by_speciality_button},
                 {'text': texts.share},
+            ], [
+                {'text': texts.search_directory_button},
             ]],
             'resize_keyboard': True
         }
@@ -36,59 +89,53 @@ def send_message_to_new_user(id):
     logger.info(f'Send start message to {id=} successfully')
 
 
-@app.task()
+@app.task(base=TelegramTask)
 def send_message_not_found(id):
     send_message('sendMessage', chat_id=id, parse_mode='HTML', text=f'<i>{texts.not_found}</i>')
     logger.info(f'Send message not found to {id=} successfully')
 
 
-@app.task()
+@app.task(base=TelegramTask)
 def send_message_not_found_share(id):
     send_message('sendMessage', chat_id=id, parse_mode='HTML', text=f'<i>{texts.not_found_share}</i>')
     logger.info(f'Send message share not found to {id=} successfully')
 
 
-@app.task()
+@app.task(base=TelegramTask)
 def send_message_before_searching(id):
     send_message('sendMessage', chat_id=id, parse_mode='HTML', text=texts.search_by_speciality_message)
     logger.info(f'Send message before searching to {id=} successfully')
 
 
-@app.task()
+@app.task(base=TelegramTask)
+def send_message_before_directory_search(id):
+    send_message('sendMessage', chat_id=id, parse_mode='HTML', text=texts.search_directory_message)
+    logger.info(f'Send message before directory search to {id=} successfully')
+
+
+@app.task(base=TelegramTask)
 def send_message_specialities(id, speciality_id=None):
     if speciality_id is None:
         text = f'<b>{texts.speciality_message}</b>'
-        where = Q()
+        reply_markup = keyboards.specialities_reply_markup()
     elif speciality_id:
         text = f'<b>{texts.speciality_message_for_search}</b>'
-        where = Q(id__in=speciality_id)
+        reply_markup = keyboards.build_specialities(speciality_id)
     elif speciality_id == []:
         send_message('sendMessage', chat_id=id, parse_mode='HTML', text=f'<i>{texts.not_found}</i>')
         logger.info(f'Send message not found to {id=} successfully')
         return
 
-    specialities = Speciality.objects.filter(where).annotate(
-        text=F('name'),
-        callback_data=Concat(
-            Value('{"type":"speciality","data":"'),
-            Cast(F('id'), output_field=CharField()),
-            Value('"}')
-        )
-    ).values('text', 'callback_data').order_by('name')
-    inline_keyboard = batched(specialities, 2)
-    reply_markup = json.dumps({'inline_keyboard': inline_keyboard})
     send_message('sendMessage', chat_id=id, parse_mode='HTML', text=text, reply_markup=reply_markup)
     logger.info(f'Send message about specialities to {id=} successfully')
 
 
-@app.task()
-def send_message_clinic_or_private(id, message_id, previous_callback_data):
-    send_message('deleteMessage', chat_id=id, message_id=message_id)
-    clinic_callback_data = json.dumps({'type': 'clinic_or_private', 'data': f'clinic,{previous_callback_data}'})
-    private_callback_data = json.dumps({'type': 'clinic_or_private', 'data': f'private,{previous_callback_data}'})
+@app.task(base=TelegramTask)
+def send_message_clinic_or_private(id, message_id, speciality_id):
+    delete_message(id, message_id)
     inline_keyboard = [[
-        {'text': texts.clinic, 'callback_data': clinic_callback_data},
-        {'text': texts.private, 'callback_data': private_callback_data}
+        {'text': texts.clinic, 'callback_data': callback.encode('clinic_or_private', 0, speciality_id)},
+        {'text': texts.private, 'callback_data': callback.encode('clinic_or_private', 1, speciality_id)}
     ]]
     reply_markup = json.dumps({'inline_keyboard': inline_keyboard})
     text = f'<b>{texts.clinic_or_private}</b>'
@@ -96,93 +143,108 @@ def send_message_clinic_or_private(id, message_id, previous_callback_data):
     logger.info(f'Send message about clinic or private to {id=} successfully')
 
 
-@app.task()
-def send_message_districts(id, message_id, previous_callback_data):
-    districts = District.objects.annotate(
-        text=F('name'),
-        callback_data=Concat(
-            Value('{"type":"district","data":"'),
-            Value(f'{previous_callback_data},'),
-            Cast(F('id'), output_field=CharField()),
-            Value('"}')
-        )
-    ).values('text', 'callback_data')
+@app.task(base=TelegramTask)
+def send_message_districts(id, message_id, clinic_or_private, speciality_id):
     text = f'<b>{texts.district}</b>'
-    inline_keyboard = batched(districts, 3)
-    reply_markup = json.dumps({'inline_keyboard': inline_keyboard})
+    reply_markup = keyboards.districts_reply_markup(clinic_or_private, speciality_id)
     send_message('editMessageText', chat_id=id, message_id=message_id, reply_markup=reply_markup, text=text, parse_mode='HTML')
     logger.info(f'Send message about districts to {id=} successfully')
 
 
-@app.task()
-def send_message_doctor(id, message_id, doctors_id):
-    send_message('deleteMessage', chat_id=id, message_id=message_id)
-    doctors = list(Doctor.objects
-                   .select_related('speciality', 'position')
-                   .prefetch_related('polyclinic', 'schedule')
-                   .filter(id__in=doctors_id).all())
-    doctors.sort(key=lambda x: doctors_id.index(x.id))
-    for doctor in doctors:
-        full_name = f'<b>{doctor.full_name}\n</b>'
-        if doctor.speciality:
-            speciality = f'{doctor.speciality._meta.verbose_name}: <i>{doctor.speciality.name}\n</i>'
-        else:
-            speciality = ''
-        if doctor.position:
-            position = f'{doctor.position._meta.verbose_name}: <i>{doctor.position.name}\n</i>'
-        else:
-            position = ''
-        polyclinics = f'{doctor.polyclinic.model._meta.verbose_name_plural}:\n'
-        for i in doctor.polyclinic.all():
-            polyclinics += f'<i>{i}</i>\n'
-        experience = f'{doctor._meta.get_field("experience").verbose_name}: <i>{doctor.experience} лет</i>\n'
-        cost = f'{doctor._meta.get_field("cost").verbose_name}: <i>{doctor.cost} грн.</i>\n'
-        schedules = f'{doctor.schedule.model._meta.verbose_name}:\n'
-        for schedule in doctor.schedule.all():
-            schedules += f'<i>{schedule}</i>\n'
-        phone = f'{doctor._meta.get_field("phone").verbose_name}:\n <i>{doctor.phone}</i>\n'
-        caption = full_name + speciality + position + polyclinics + experience + cost + schedules + phone
-        send_message('sendPhoto', chat_id=id, parse_mode='HTML', caption=caption, photo=doctor.image.path)
-        logger.info(f'Send message about doctor to {id=} successfully')
-
-
-@app.task()
-def send_message_polyclinic(id, message_id, polyclinics_id):
+@app.task(base=TelegramTask)
+def send_message_doctor(id, message_id, doctors_id, more_callback_data=None, remaining=0):
     if message_id:
-        send_message('deleteMessage', chat_id=id, message_id=message_id)
-    polyclinics = list(Polyclinic.objects.select_related('district')
-                       .prefetch_related('phone', 'speciality', 'address')
-                       .filter(id__in=polyclinics_id).all())
-    polyclinics.sort(key=lambda x: polyclinics_id.index(x.id))
-    for polyclinic in polyclinics:
-        name = f'<b>{polyclinic.name}\n</b>'
-        addresses = f'{polyclinic.address.model._meta.verbose_name}:\n'
-        for address in polyclinic.address.all():
-            addresses += f'<i>{address.name}</i>\n'
-        phones = f'{polyclinic.phone.model._meta.verbose_name}:\n'
-        for phone in polyclinic.phone.all():
-            phones += f'<i>{phone.number}</i>\n'
-        url = polyclinic.site_url if polyclinic.site_url else ''
-        site = f'{polyclinic._meta.get_field("site_url").verbose_name}: <a href="{url}">{url}</a>\n'
-        work_time = f'{polyclinic.work_time.short_description}: <i>{polyclinic.work_time()}</i>\n'
-        caption = name + addresses + site + work_time + phones
-        send_message('sendPhoto', chat_id=id, parse_mode='HTML', caption=caption, photo=polyclinic.image.path)
-        logger.info(f'Send message about polyclinic to {id=} successfully')
-
-
-@app.task()
+        delete_message(id, message_id)
+    cards = captions.get_cards('doctor', doctors_id)
+    send_cards(id, cards)
+    logger.info(f'Send message about {len(cards)} doctors to {id=} successfully')
+    if more_callback_data:
+        send_more_button(id, more_callback_data, remaining)
+
+
+@app.task(base=TelegramTask)
+def send_message_polyclinic(id, message_id, polyclinics_id, more_callback_data=None, remaining=0):
+    if message_id:
+        delete_message(id, message_id)
+    cards = captions.get_cards('polyclinic', polyclinics_id)
+    send_cards(id, cards)
+    logger.info(f'Send message about {len(cards)} polyclinics to {id=} successfully')
+    if more_callback_data:
+        send_more_button(id, more_callback_data, remaining)
+
+
+@app.task(base=TelegramTask)
 def send_message_share(id, shares_id):
-    shares = list(Share.objects.filter(id__in=shares_id).all())
-    shares.sort(key=lambda x: shares_id.index(x.id))
-    for share in shares:
-        name = f'<b>{share.name}\n</b>'
-        start_date = f'{share._meta.get_field("start_date").verbose_name}: <i>{share.start_date:%d.%m.%Y}</i>\n'
-        end_date = f'{share._meta.get_field("end_date").verbose_name}: <i>{share.end_date:%d.%m.%Y}</i>\n'
-        description = f'{share.description}\n'
-        if share.sum:
-            sum = f'{share._meta.get_field("sum").verbose_name}: <i>{share.sum} грн.</i>\n'
-        else:
-            sum = ''
-        caption = name + description + start_date + end_date + sum
-        send_message('sendPhoto', chat_id=id, parse_mode='HTML', caption=caption, photo=share.image.path)
+    for image_name, caption in captions.get_cards('share', shares_id):
+        with_retry_after(send_photo, image_name, chat_id=id, parse_mode='HTML', caption=caption)
         logger.info(f'Send message about share to {id=} successfully')
+
+
+@app.task
+def broadcast_share(share_id):
+    # User ids are streamed from a cursor and queued in small batches, the
+    # whole table is never held in memory
+    broadcast.start(share_id)
+    users = User.objects.filter(is_deleted=False, is_bot=False).order_by('id').values_list('id', flat=True)
+    batch = []
+    for user_id in users.iterator(chunk_size=settings.BROADCAST_CHUNK_SIZE):
+        batch.append(user_id)
+        if len(batch) == settings.BROADCAST_BATCH_SIZE:
+            broadcast.add(share_id, queued=len(batch))
+            send_broadcast_batch.delay(share_id, batch)
+            batch = []
+    if batch:
+        broadcast.add(share_id, queued=len(batch))
+        send_broadcast_batch.delay(share_id, batch)
+    logger.info(f'Broadcast of share {share_id} queued')
+
+
+@app.task(base=TelegramTask)
+def send_broadcast_batch(share_id, users_id):
+    cards = captions.get_cards('share', [share_id])
+    if not cards:
+        logger.warning(f'Share {share_id} no longer exists, broadcast batch skipped')
+        return
+    image_name, caption = cards[0]
+    sent, failed, blocked = 0, 0, []
+    try:
+        for user_id in users_id:
+            try:
+                # Retrying the task would send the batch again, a 429 is waited out here
+                with_retry_after(send_photo, image_name, chat_id=user_id, parse_mode='HTML', caption=caption)
+                sent += 1
+            except BlockedException:
+                blocked.append(user_id)
+            except (TelegramException, ResponseException, RequestException):
+                # ResponseException includes a 429 that outlasted TELEGRAM_MAX_RETRIES
+                failed += 1
+    finally:
+        # Users not reached because of an unexpected error count as failed, so
+        # the progress still adds up to the queued count
+        failed += len(users_id) - sent - failed - len(blocked)
+        if blocked:
+            newly_blocked = User.objects.filter(id__in=blocked, is_deleted=False).update(is_deleted=True)
+            stats.record_users(blocked=newly_blocked)
+        broadcast.add(share_id, sent=sent, blocked=len(blocked), failed=failed)
+        logger.info(f'Broadcast of share {share_id}: {sent} sent, {len(blocked)} blocked, {failed} failed')
+
+
+@app.task
+def flush_user_activity():
+    activity.flush()
+
+
+@app.task
+def get_users_count():
+    # The running counters drift only by races between a flush and a broadcast,
+    # so the full count runs once to seed them and then every few hours
+    counts = User.objects.aggregate(total=Count('id'), blocked=Count('id', filter=Q(is_deleted=True)))
+    stats.set_users_count(counts['total'], counts['blocked'])
+    logger.info(f'Users: {counts["total"]}, blocked the bot: {counts["blocked"]}')
+
+
+@app.task
+def rollup_stats():
+    if not stats.users_seeded():
+        get_users_count()
+    stats.rollup_recent()
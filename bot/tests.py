@@ -1,3 +1,96 @@
-from django.test import TestCase
+import datetime
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from bot import captions
+from bot.models import Doctor, Polyclinic, Schedule, Speciality, Position, Address, Phone, District
 
-# Create your tests here.
+
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class CaptionsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        speciality = Speciality.objects.create(name='Speciality')
+        position = Position.objects.create(name='Position')
+        cls.doctors_id = []
+        for i in range(5):
+            polyclinic = Polyclinic.objects.create(name=f'Polyclinic {i}')
+            polyclinic.address.add(Address.objects.create(name=f'Address {i}'))
+            polyclinic.phone.add(Phone.objects.create(number=f'{i}'))
+            doctor = Doctor.objects.create(
+                first_name=f'First {i}', last_name=f'Last {i}', paternal_name=f'Paternal {i}',
+                phone=f'{i}', speciality=speciality, position=position,
+            )
+            doctor.polyclinic.add(polyclinic)
+            for day in '12':
+                doctor.schedule.add(Schedule.objects.create(
+                    day_of_week=day, start_time=datetime.time(9), end_time=datetime.time(18), polyclinic=polyclinic,
+                ))
+            cls.doctors_id.append(doctor.id)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_doctor_cards_query_count(self):
+        # Doctors with speciality and position, polyclinics, their addresses,
+        # schedules with their polyclinic, and those polyclinics' addresses
+        with self.assertNumQueries(5):
+            cards = captions.get_cards('doctor', self.doctors_id)
+        self.assertEqual(len(cards), len(self.doctors_id))
+        for doctor_id, (_, caption) in zip(self.doctors_id, cards):
+            doctor = Doctor.objects.get(id=doctor_id)
+            self.assertIn(doctor.last_name, caption)
+
+    def test_cached_cards_run_no_queries(self):
+        captions.get_cards('doctor', self.doctors_id)
+        with self.assertNumQueries(0):
+            captions.get_cards('doctor', self.doctors_id)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ChangelistQueriesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def add_polyclinics(self, count):
+        district = District.objects.create(name=f'District {District.objects.count()}')
+        for _ in range(count):
+            i = Polyclinic.objects.count()
+            polyclinic = Polyclinic.objects.create(name=f'Polyclinic {i}', district=district)
+            polyclinic.address.add(Address.objects.create(name=f'Address {i}'))
+            polyclinic.phone.add(Phone.objects.create(number=f'{i}'))
+
+    def assertChangelistQueries(self, url, num):
+        # A page with twice the rows must not take more queries
+        self.add_polyclinics(5)
+        for _ in range(2):
+            with self.assertNumQueries(num):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.add_polyclinics(Polyclinic.objects.count())
+
+    def test_polyclinic_changelist(self):
+        self.assertChangelistQueries('/admin/bot/polyclinic/', 9)
+
+    def test_phone_changelist(self):
+        self.assertChangelistQueries('/admin/bot/phone/', 5)
+
+    def test_address_changelist(self):
+        self.assertChangelistQueries('/admin/bot/address/', 5)
+
+    def test_autocomplete_skips_polyclinics_aggregate(self):
+        self.add_polyclinics(3)
+        with self.assertNumQueries(4) as context:
+            response = self.client.get('/admin/autocomplete/', {
+                'term': 'Address', 'app_label': 'bot', 'model_name': 'polyclinic', 'field_name': 'address',
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertFalse(any('GROUP BY' in query['sql'] for query in context.captured_queries))
@@ -32,3 +32,11 @@ search_by_speciality_button = '🔍 Поиск по специальности'
 search_by_speciality_message = 'Отправьте название специальности (минимум 3 буквы)'
 
 share = '💸 Акции'
+
+more = 'Показать ещё'
+
+more_message = 'Показать следующие результаты?'
+
+search_directory_button = '🔎 Поиск врача или клиники'
+
+search_directory_message = 'Отправьте фамилию врача, название клиники или адрес (минимум 3 буквы)'
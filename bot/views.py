@@ -1,8 +1,8 @@
 import logging
 import json
 from datetime import datetime
+from asgiref.sync import sync_to_async
 from django.http import HttpResponse
-from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.core.cache import cache
 from django.db.models import Q
@@ -10,24 +10,55 @@ from bot.misc import DotAccessibleDict
 from bot.tasks import send_message_to_new_user, send_message_specialities, \
     send_message_districts, send_message_doctor, send_message_clinic_or_private, \
     send_message_polyclinic, send_message_before_searching, send_message_not_found, \
-    send_message_not_found_share, send_message_share, send_message_approve
-from bot.models import User, Doctor, Polyclinic, Speciality, Share
-from bot import texts
-
-
-def create_new_user(from_user):
-    if not User.objects.filter(id=from_user.id).exists():
-        user = User.objects.create(
-            id=from_user.id,
-            username=from_user.username if from_user.username else None,
-            first_name=from_user.first_name if from_user.first_name else None,
-            last_name=from_user.last_name if from_user.last_name else None,
-        )
-        logging.info(f'Create new user: {user.id} {user.username} {user.first_name} {user.last_name}')
-
-
-@csrf_exempt
-def telegram_webhook(request):
+    send_message_not_found_share, send_message_share, send_message_approve, \
+    send_message_before_directory_search
+from bot.models import Share
+from bot import texts, index, search, state, callback, activity, stats
+
+
+DUPLICATE_UPDATES_KEY = 'telegram_duplicate_updates'
+
+
+async def enqueue(task, *args, **kwargs):
+    # Publishing to the broker is a blocking socket write, keep it off the event loop
+    await sync_to_async(task.delay, thread_sensitive=False)(*args, **kwargs)
+
+
+async def is_duplicate_update(update_id):
+    # Telegram redelivers an update while our 200 is late, each delivery must be handled once
+    if await cache.aadd(f'update_{update_id}', True, timeout=settings.TELEGRAM_UPDATE_DEDUP_TTL):
+        return False
+    await cache.aadd(DUPLICATE_UPDATES_KEY, 0, timeout=None)
+    duplicates = await cache.aincr(DUPLICATE_UPDATES_KEY)
+    logging.warning(f'Dropped duplicate update {update_id}, {duplicates} duplicates dropped in total')
+    return True
+
+
+async def send_results(user_id, message_id, clinic_or_private, speciality_id, district_id, offset=0):
+    if clinic_or_private == 'private':
+        task = send_message_doctor
+    elif clinic_or_private == 'clinic':
+        task = send_message_polyclinic
+    else:
+        return
+    results_id = await index.aget_results(clinic_or_private, speciality_id, district_id)
+    if offset == 0:
+        await stats.arecord_search(clinic_or_private, speciality_id, district_id, len(results_id))
+    page = results_id[offset:offset + settings.RESULTS_PAGE_SIZE]
+    if not page:
+        await enqueue(send_message_not_found, id=user_id)
+        return
+    next_offset = offset + len(page)
+    remaining = len(results_id) - next_offset
+    if remaining > 0:
+        choice = callback.CLINIC_OR_PRIVATE.index(clinic_or_private)
+        more_callback_data = callback.encode('more', choice, speciality_id, district_id, next_offset)
+    else:
+        more_callback_data = None
+    await enqueue(task, user_id, message_id, page, more_callback_data, remaining)
+
+
+async def telegram_webhook(request):
     if request.method == 'POST' and request.headers.get('X-Telegram-Bot-Api-Secret-Token') == settings.X_TELEGRAM_BOT_API_SECRET_TOKEN:
         try:
             body = json.loads(request.body)
@@ -38,89 +69,108 @@ def telegram_webhook(request):
             logging.exception(e)
             return HttpResponse(status=200)
 
+        if body.update_id and await is_duplicate_update(body.update_id):
+            return HttpResponse(status=200)
+
         # return HttpResponse(status=200)
 
         if body.chat_join_request:
             request = body.chat_join_request
-            # create_new_user(request.from_user)
             logging.info(f'Incoming chat join request from: {request.from_user.id} {request.from_user.username}')
             logging.info(f'Chat: {request.chat.id} {request.chat.title}, invite link: {request.invite_link.invite_link}')
-            # send_message_approve.delay(request.from_user.id, request.chat.id)
-            # send_message_to_new_user.delay(request.from_user.id)
+            # await enqueue(send_message_approve, request.from_user.id, request.chat.id)
+            # await enqueue(send_message_to_new_user, request.from_user.id)
 
         if body.message.text:
             message = body.message
             logging.info(f'Incoming message from: {message.from_user.id} {message.from_user.username}, {message.text}')
 
-            search_request = cache.get(f'{message.from_user.id}_search_request')
+            conversation = await state.aget_state(message.from_user.id)
+            search_request = conversation.get('search')
+
+            await activity.arecord(message.from_user)
 
             if message.text == '/start':
-                create_new_user(message.from_user)
-                send_message_to_new_user.delay(message.from_user.id)
+                await enqueue(send_message_to_new_user, message.from_user.id)
 
             elif message.text == texts.my_doctor_button:
-                send_message_specialities.delay(message.from_user.id)
+                await enqueue(send_message_specialities, message.from_user.id)
 
             elif message.text == texts.search_by_speciality_button:
-                cache.set(f'{message.from_user.id}_search_request', True, timeout=3600)
-                send_message_before_searching(message.from_user.id)
+                await state.aupdate_state(message.from_user.id, search='speciality')
+                await enqueue(send_message_before_searching, message.from_user.id)
+
+            elif message.text == texts.search_directory_button:
+                await state.aupdate_state(message.from_user.id, search='directory')
+                await enqueue(send_message_before_directory_search, message.from_user.id)
 
             elif message.text == texts.share:
                 where = Q(
                     # Q(start_date__lte=datetime.today().date()) &
                     Q(end_date__gte=datetime.today().date())
                 )
-                shares = Share.objects.filter(where).values('id', 'rating')
+                shares = [i async for i in Share.objects.filter(where).values('id', 'rating')]
                 if shares:
                     shares = sorted(shares, key=lambda x: int(x['rating']) if x['rating'] else 10, reverse=True)
                     shares_id = [i['id'] for i in shares]
-                    send_message_share.delay(message.from_user.id, shares_id)
+                    await enqueue(send_message_share, message.from_user.id, shares_id)
                 else:
-                    send_message_not_found_share.delay(id=message.from_user.id)
-
-            elif search_request and len(message.text) >= 3:
+                    await enqueue(send_message_not_found_share, id=message.from_user.id)
+
+            elif search_request == 'directory' and len(message.text) >= 3:
+                logging.info(f'User {message.from_user.id} searching doctors and clinics: {message.text}')
+                doctors_id, polyclinics_id = await search.asearch_directory(message.text)
+                await stats.arecord_directory_search(len(doctors_id) + len(polyclinics_id))
+                if doctors_id:
+                    await enqueue(send_message_doctor, message.from_user.id, None, doctors_id)
+                if polyclinics_id:
+                    await enqueue(send_message_polyclinic, message.from_user.id, None, polyclinics_id)
+                if not (doctors_id or polyclinics_id):
+                    await enqueue(send_message_not_found, id=message.from_user.id)
+
+            elif search_request == 'speciality' and len(message.text) >= 3:
                 logging.info(f'User {message.from_user.id} searching by speciality: {message.text}')
-                speciality_id = Speciality.objects.filter(name__icontains=message.text).values_list('id', flat=True)
-                send_message_specialities.delay(message.from_user.id, list(speciality_id))
+                speciality_id = await search.asearch_specialities(message.text)
+                await enqueue(send_message_specialities, message.from_user.id, speciality_id)
 
         if body.callback_query:
             message = body.callback_query
             logging.info(f'Incoming callback_query from: {message.from_user.id} '
                          f'{message.from_user.username}, {message.data}')
+            user_id = message.from_user.id
+            message_id = message.message.message_id
+            await activity.arecord(message.from_user)
             try:
-                data = json.loads(body.callback_query.data)
-            except json.JSONDecodeError:
-                logging.error(f'JSONDecodeError: {body.callback_query.data}')
+                step, values = callback.decode(message.data)
+            except ValueError as e:
+                # Buttons sent before a format change land here, start the search over
+                logging.error(f'Callback data error: {e}')
+                await enqueue(send_message_specialities, user_id)
                 return HttpResponse(status=200)
 
-            if data.get('type') == 'speciality':
-                send_message_clinic_or_private.delay(message.from_user.id, message.message.message_id, data['data'])
-
-            if data.get('type') == 'clinic_or_private':
-                send_message_districts.delay(message.from_user.id, message.message.message_id, data['data'])
-
-            if data.get('type') == 'district':
-                clinic_or_private, speciality_id, district_id = data['data'].split(',')
-                speciality_id = int(speciality_id)
-                district_id = int(district_id)
-
-                if clinic_or_private == 'private':
-                    doctors = Doctor.objects.filter(district__id=district_id, speciality=speciality_id).values('id', 'rating')
-                    if doctors:
-                        doctors = sorted(doctors, key=lambda x: int(x['rating']) if x['rating'] else 10, reverse=True)
-                        doctors_id = [i['id'] for i in doctors]
-                        send_message_doctor.delay(message.from_user.id, message.message.message_id, doctors_id)
-                    else:
-                        send_message_not_found(id=message.from_user.id)
-
-                elif clinic_or_private == 'clinic':
-                    polyclinics = Polyclinic.objects.filter(speciality__id=speciality_id, district=district_id).values('id', 'rating')
-                    if polyclinics:
-                        polyclinics = sorted(polyclinics, key=lambda x: int(x['rating']) if x['rating'] else 10, reverse=True)
-                        polyclinics_id = [i['id'] for i in polyclinics]
-                        send_message_polyclinic.delay(message.from_user.id, message.message.message_id, polyclinics_id)
-                    else:
-                        send_message_not_found(id=message.from_user.id)
+            # A button carries every choice of its own search, so an old button
+            # keeps working on that search whatever the user did since
+            if step == 'speciality':
+                await enqueue(send_message_clinic_or_private, user_id, message_id, values[0])
+
+            elif step == 'clinic_or_private':
+                choice, speciality_id = values
+                await enqueue(send_message_districts, user_id, message_id,
+                              callback.CLINIC_OR_PRIVATE[choice], speciality_id)
+
+            elif step == 'district':
+                choice, speciality_id, district_id = values
+                await send_results(user_id, message_id, callback.CLINIC_OR_PRIVATE[choice], speciality_id, district_id)
+
+            elif step == 'more':
+                choice, speciality_id, district_id, offset = values
+                await send_results(user_id, message_id, callback.CLINIC_OR_PRIVATE[choice],
+                                   speciality_id, district_id, offset)
 
         return HttpResponse(status=200)
     return HttpResponse(status=400)
+
+
+# csrf_exempt() wraps views in a sync function in Django 4.2, which would hide
+# the coroutine from the handler, so the flag is set directly
+telegram_webhook.csrf_exempt = True